@@ -0,0 +1,214 @@
+""" Batch crawl of 13F filings into an append-only holdings file.
+
+Filings are given as index urls or accession numbers (one per line in a
+file), or as a quarter whose 13F-HR filings are listed from the local catalog
+(see catalog.py). Each crawled filing is appended to the output as one
+record: a RECORD header (url and payload lengths), the url, then the
+zlib-compressed JSON payload. The output is also the checkpoint: a rerun
+skips urls already in it, so a killed run resumes where it left off.
+
+    python batch.py 2014Q1 holdings.dat [workers] [rate]
+    python batch.py filings.txt holdings.dat [workers] [rate]
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from collections import Counter
+from Queue import Empty, Queue
+
+import catalog
+import crawler
+import fetch
+
+# CONSTANTS
+ROOT = "http://www.sec.gov"
+RECORD = struct.Struct('<HI') # url length, payload length
+LOG_EVERY = 100 # filings between progress log lines
+
+def filing_url(item, root=ROOT):
+    """Index url for item: urls are returned as is, accession numbers are
+    looked up in the catalog. OUTPUT: url, or None if unknown"""
+
+    item = item.strip()
+    if item.startswith('http'):
+        return item
+    if re.match(r'\d{10}-\d{2}-\d{6}$', item):
+        filename = catalog.accession_filename(item)
+        if filename:
+            return "{}{}".format(root, catalog.index_slug(filename))
+
+    return None
+
+def quarter_urls(quarter, form='13F-HR', root=ROOT):
+    """Index urls of the catalog's filings of form in quarter ('2014Q1')"""
+
+    year, qtr = map(int, re.match(r'(\d{4})Q([1-4])$', quarter.upper()).groups())
+    since = "{}-{:02d}-01".format(year, 3 * qtr - 2)
+    until = "{}-{:02d}-01".format(year + qtr // 4, 3 * qtr % 12 + 1)
+
+    return ["{}{}".format(root, catalog.index_slug(filename))
+        for date, form, company, filename
+        in catalog.form_filings(form, since, until)]
+
+def read(path):
+    """Yields (url, payload) for each complete record in a batch output
+    file; payload is a dict of as_of, mv_rep, ct_rep and holdings rows"""
+
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            url_len, data_len = RECORD.unpack(header)
+            url = f.read(url_len)
+            data = f.read(data_len)
+            if len(data) < data_len:
+                return
+            yield url, json.loads(zlib.decompress(data))
+
+def resume(path):
+    """Urls already recorded in path. A record left incomplete by a killed
+    run is truncated so appends start on a record boundary."""
+
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    end = 0
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while end + RECORD.size <= size:
+            url_len, data_len = RECORD.unpack(f.read(RECORD.size))
+            if end + RECORD.size + url_len + data_len > size:
+                break
+            done.add(f.read(url_len))
+            f.seek(data_len, os.SEEK_CUR)
+            end += RECORD.size + url_len + data_len
+
+    if end < size:
+        logging.warning("truncating incomplete record at byte %d", end)
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+
+    return done
+
+class Metrics:
+    """ Thread-safe counts of crawled, empty and failed filings (failures
+    by exception type) with throughput since start """
+
+    def __init__(self, skipped=0):
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.crawled = self.empty = self.failed = 0
+        self.skipped = skipped
+        self.errors = Counter()
+
+    def add(self, holdings=None, error=None):
+
+        with self.lock:
+            if error is not None:
+                self.failed += 1
+                self.errors[type(error).__name__] += 1
+            else:
+                self.crawled += 1
+                self.empty += not holdings
+
+    def per_minute(self):
+
+        elapsed = time.time() - self.started
+        return 60 * (self.crawled + self.failed) / elapsed if elapsed else 0.
+
+    def summary(self):
+
+        return dict(crawled=self.crawled, empty=self.empty,
+            failed=self.failed, skipped=self.skipped,
+            errors=dict(self.errors), per_minute=round(self.per_minute(), 1))
+
+def crawl(urls, path, workers=fetch.WORKERS, rate=fetch.SEC_RATE):
+    """Crawls urls with crawler.crawl_filing on 'workers' threads, at most
+    'rate' requests per second in all (cache hits aren't limited), appending
+    each filing to path as it completes. Failures are logged and counted,
+    not recorded, so a rerun retries them.
+    OUTPUT: Metrics summary dict"""
+
+    done = resume(path)
+    todo, seen = [], set(done)
+    for url in urls:
+        if url not in seen:
+            seen.add(url)
+            todo.append(url)
+    metrics = Metrics(skipped=len(urls) - len(todo))
+
+    fetch.limiter = fetch.RateLimiter(rate, per_host=False)
+    queue = Queue()
+    for url in todo:
+        queue.put(url)
+    lock = threading.Lock()
+    out = open(path, 'ab')
+
+    def worker():
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                holdings, as_of, mv_rep, ct_rep = crawler.crawl_filing(url)
+            except Exception as e:
+                logging.warning("failed %s: %r", url, e)
+                metrics.add(error=e)
+                continue
+
+            data = zlib.compress(json.dumps(dict(as_of=as_of, mv_rep=mv_rep,
+                ct_rep=ct_rep, holdings=holdings), separators=(',', ':')))
+            with lock:
+                out.write(RECORD.pack(len(url), len(data)) + url + data)
+                out.flush()
+            metrics.add(holdings)
+            count = metrics.crawled + metrics.failed
+            if count % LOG_EVERY == 0:
+                logging.info("%d/%d filings, %.1f/min", count, len(todo),
+                    metrics.per_minute())
+
+    threads = [threading.Thread(target=worker)
+        for i in xrange(min(workers, len(todo)))]
+    for thread in threads:
+        thread.daemon = True # so an interrupted run exits promptly
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        with lock:
+            out.close()
+
+    return metrics.summary()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    source, path = sys.argv[1:3]
+    if os.path.exists(source):
+        with open(source) as f:
+            items = [line for line in f if line.strip()]
+        urls = [filing_url(item) for item in items]
+        for item, url in zip(items, urls):
+            if url is None:
+                logging.warning("not a url or catalogued accession: %s",
+                    item.strip())
+        urls = [url for url in urls if url]
+    else:
+        urls = quarter_urls(source)
+    options = map(float, sys.argv[3:5])
+    if options:
+        options[0] = int(options[0])
+    print json.dumps(crawl(urls, path, *options))
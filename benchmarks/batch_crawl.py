@@ -0,0 +1,169 @@
+""" End to end batch crawl (batch.py) against a stub EDGAR (see
+stub_edgar.py): accession numbers are looked up in a catalog ingested from
+data/full-index/master.idx, their filings crawled from the stub into an
+append-only holdings file, then a killed run is resumed.
+
+Text filings are the 13F tables in data/13f-txt and the XML filing is
+data/13f-xml. Every record must hold the holdings and totals of its
+fixture; the run must stay under 'rate' requests per second; and after the
+output's last record is cut short, a rerun must crawl only that filing
+(plus the one whose index page is missing, which fails both times) and
+the holders index must list each filing once. The catalog, holders index
+and output go to a temporary directory.
+
+    python benchmarks/batch_crawl.py [workers] [rate]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+TMP = tempfile.mkdtemp()
+os.environ['OPENSEC_CATALOG'] = os.path.join(TMP, 'catalog.db')
+os.environ['OPENSEC_HOLDERS_DIR'] = os.path.join(TMP, 'holders')
+import batch
+import catalog
+import crawler
+import fetch
+import holders
+import stub_edgar
+
+DATA_DIR = os.path.join(HERE, 'data')
+INDEX_PATH = os.path.join(DATA_DIR, 'full-index', 'master.idx')
+TEXT_FILINGS = { # accession => data/13f-txt fixture
+    '0000950123-11-014599': 'legacy-table.txt',
+    '0001000002-14-000001': 'synthetic-40.txt',
+    '0001000003-14-000001': 'synthetic-150.txt',
+    '0001000004-14-000001': 'synthetic-400.txt',
+    '0001000005-14-000001': 'synthetic-1200.txt',
+}
+XML_FILING = '0001000006-14-000001'
+MISSING = '0001000007-14-000001' # catalogued, but its index page 404s
+UNKNOWN = '0009999999-14-000001' # not in the catalog
+AS_OF = '2013-12-31'
+XML_HOLDINGS = [
+    ['APPLE INC', '037833100', 561, 1000, ''],
+    ['APPLE INC', '037833100', 112, 200, 'CALL'],
+    ['INTERNATIONAL BUSINESS MACHS', '459200101', 375, 2000, ''],
+    ['MICROSOFT CORP', '594918104', 300, 8000, ''],
+    ['SPDR S&P 500 ETF TR', '78462F103', 175, 950, 'PUT'],
+]
+
+def read(*parts):
+
+    with open(os.path.join(DATA_DIR, *parts)) as f:
+        return f.read()
+
+def index_page(documents, xml=False):
+    """ A filing index page as crawl_filing reads it: the period of report
+    50 characters after its label, links to documents """
+
+    head = 'Period of Report</div>\n'
+    head += ' ' * (50 - len(head) - len('<div>')) + '<div>'
+
+    return '{}{}</div>\n{}\n{}'.format(head, AS_OF,
+        '<td>INFORMATION TABLE</td>' if xml else '',
+        '\n'.join('<a href="{}">{}</a>'.format(doc, doc.rsplit('/', 1)[-1])
+            for doc in documents))
+
+def edgar():
+    """ pages(path, query) serving the fixture filings, and the expected
+    (holdings, mv_rep, ct_rep) by accession """
+
+    pages, expected = {}, {}
+    for cik, company, form, date, filename in catalog.parse_index(
+            open(INDEX_PATH)):
+        acc = catalog.filename_accession(filename)
+        index = catalog.index_slug(filename)
+        folder = index.rsplit('/', 1)[0]
+        if acc in TEXT_FILINGS:
+            text = read('13f-txt', TEXT_FILINGS[acc])
+            pages[index] = index_page([folder + '/' + acc + '.txt'])
+            pages[folder + '/' + acc + '.txt'] = text
+            expected[acc] = crawler.scan_txt(text.split('\n'))
+        elif acc == XML_FILING:
+            docs = [folder + '/primary_doc.xml', folder + '/infotable.xml']
+            pages[index] = index_page(docs, xml=True)
+            pages[docs[0]] = read('13f-xml', 'primary_doc.xml')
+            pages[docs[1]] = read('13f-xml', 'infotable.xml')
+            expected[acc] = (XML_HOLDINGS, 1523, 5)
+
+    return lambda path, query: pages.get(path), expected
+
+def run(server, urls, path, workers, rate):
+    """ (batch.crawl summary, requests, busiest second) """
+
+    server.reset()
+    summary = batch.crawl(urls, path, workers, rate)
+    arrivals = server.reset()
+
+    return (summary, len(arrivals),
+        stub_edgar.max_per_second([at for at, page in arrivals]))
+
+def check(path, expected):
+    """ Asserts each record of path holds its fixture's parse """
+
+    records = list(batch.read(path))
+    for url, payload in records:
+        holdings, mv_rep, ct_rep = expected[crawler.ACCESSION_P.search(
+            url).group()]
+        assert payload['holdings'] == holdings, "holdings differ: " + url
+        assert (payload['mv_rep'], payload['ct_rep']) == (mv_rep, ct_rep)
+        assert payload['as_of'] == AS_OF
+    assert len(set(url for url, payload in records)) == len(records), \
+        "a filing was recorded twice"
+
+    return len(records)
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else fetch.SEC_RATE
+    out = os.path.join(TMP, 'holdings.dat')
+
+    try:
+        catalog.ingest([INDEX_PATH])
+        fetch.cache.enabled = False
+        page, expected = edgar()
+        with stub_edgar.StubServer(page) as server:
+            items = sorted(expected) + [MISSING, UNKNOWN]
+            urls = [batch.filing_url(item, server.url) for item in items]
+            assert urls[-1] is None, "unknown accession found"
+            assert all(url and url.startswith(server.url + '/Archives/')
+                for url in urls[:-1]), "accession not found in the catalog"
+            urls = urls[:-1]
+            assert len(batch.quarter_urls('2014Q1', root=server.url)) == 6
+
+            start = time.time()
+            first, requests, busiest = run(server, urls, out, workers, rate)
+            elapsed = time.time() - start
+            recorded = check(out, expected)
+            print "first run:  {} ({} requests, {:.1f}s, busiest second " \
+                "{})".format(first, requests, elapsed, busiest)
+            assert (first['crawled'], first['failed']) == (len(expected), 1)
+            assert recorded == len(expected)
+            assert busiest <= rate + 1, "rate limit exceeded"
+
+            with open(out, 'r+b') as f: # as if killed mid-write
+                f.truncate(os.path.getsize(out) - 7)
+            second, requests, busiest = run(server, urls, out, workers, rate)
+            recorded = check(out, expected)
+            print "resumed:    {} ({} requests)".format(second, requests)
+            assert (second['crawled'], second['failed'],
+                second['skipped']) == (1, 1, len(expected) - 1)
+            assert recorded == len(expected)
+
+        with open(holders.INDEXED_PATH) as f:
+            indexed = f.read().split()
+        assert sorted(indexed) == sorted(expected), "holders index differs"
+        assert ('0001000006', AS_OF, 1000, 561) in holders.top('037833100', 100)
+        with open(holders._path('037833100'), 'rb') as f: # one posting each
+            data = f.read()
+        ciks = [holders.POSTING.unpack_from(data, offset)[0]
+            for offset in xrange(0, len(data), holders.POSTING.size)]
+        assert len(ciks) == len(set(ciks)), "a filing was indexed twice"
+    finally:
+        shutil.rmtree(TMP)
@@ -0,0 +1,79 @@
+""" Memory of parsed XBRL facts for a company's worth of filings: bytes per
+fact held by facts.Facts columns (nbytes) and the process RSS growth from
+keeping 'filings' parsed filings, against the list of (name, period,
+value, segment) tuples Filing.instances used to be.
+
+Filings are the sample instances in data/ scaled up by 'copies' (see
+instances.py), parsed with Filing(url, stream=True). Each representation
+is loaded in a fresh process; RSS is read from /proc (Linux).
+
+    python benchmarks/fact_memory.py [filings] [copies]
+"""
+
+import gc
+import glob
+import os
+import StringIO
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fins
+import instances
+
+def rss():
+    """ Resident set size of this process in bytes """
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def load(mode, count, copies):
+    """ Parses count filings, keeping each one's facts as mode ('facts' or
+    'tuples'). OUTPUT: (facts, RSS growth, column bytes, seconds) """
+
+    samples = []
+    for path in sorted(glob.glob(os.path.join(instances.DATA_DIR, '*.xml'))):
+        with open(path) as f:
+            samples.append(instances.scale(f.read(), copies))
+    fins.fetch.open_url = lambda url: StringIO.StringIO(
+        samples[int(url) % len(samples)])
+
+    gc.collect()
+    before, start = rss(), time.time()
+    kept = []
+    for ix in xrange(count):
+        if mode == 'facts':
+            kept.append(fins.Filing(str(ix), stream=True).instances)
+        else:
+            filing = instances._filing()
+            kept.append(list(filing.stream_instances(
+                fins.fetch.open_url(str(ix)))))
+    elapsed = time.time() - start
+    gc.collect()
+
+    nbytes = sum(table.nbytes() for table in kept) if mode == 'facts' else 0
+    return sum(len(table) for table in kept), rss() - before, nbytes, elapsed
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        mode, count, copies = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        print ' '.join(map(str, load(mode, count, copies)))
+        sys.exit()
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    print "{} filings, sample instances x{}".format(count, copies)
+    print "{:<8} {:>10} {:>10} {:>12} {:>13} {:>8}".format('facts as',
+        'facts', 'RSS MB', 'RSS B/fact', 'column B/fact', 'parse s')
+    for mode in ['tuples', 'facts']:
+        out = subprocess.check_output([sys.executable, __file__, '--child',
+            mode, str(count), str(copies)])
+        facts, grown, nbytes, elapsed = out.split()
+        facts, grown, nbytes = int(facts), int(grown), int(nbytes)
+        print "{:<8} {:>10,} {:>10,.0f} {:>12,.0f} {:>13} {:>8.1f}".format(
+            mode, facts, grown / 2.**20, float(grown) / facts,
+            "{:.1f}".format(float(nbytes) / facts) if nbytes else '-',
+            float(elapsed))
@@ -0,0 +1,186 @@
+""" Company.impute_periods against its previous version, which compared
+every period with every other and parsed dates in the inner loop.
+
+The history is the sample instances in data/, parsed with fins.Filing,
+plus 'years' years of synthetic filings in the same shape: each 10-Q
+reports its quarter, its year to date and the prior year's same periods,
+and each 10-K three fiscal years and its fourth quarter. Both versions must
+impute the same periods, in the same order, and hist_quarters must keep the
+same quarter for every end date.
+
+    python benchmarks/impute_periods.py [years...]
+"""
+
+import datetime
+import glob
+import new
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fetch
+import fins
+
+DATA_DIR = os.path.join(HERE, 'data')
+DFMT = '%Y-%m-%d'
+QUERIES = ['Revenues', 'WeightedAverageDilutedShares', 'EarningsPerShare']
+
+def inc_days(date, num):
+
+    date = datetime.datetime.strptime(date, DFMT)
+    return (date + datetime.timedelta(days=num)).strftime(DFMT)
+
+def old_impute_periods(company, fields, average=False):
+    """ impute_periods before dates were indexed by ordinal """
+
+    imputed = []
+    # remove duplicates:
+    fields = list(set(fields))
+    # iterate backwords to avoid interacting with new items
+    for el in fields:
+        fdate = "{}*".format(el[3])
+        # if 'el' non-quarterly, try to impute smaller periods
+        if el[0] > 100:
+            for other in fields:
+                # same enddate + 'other' starts later => impute earlier
+                if other[1][0] == el[1][0] and other[1][1] > el[1][1]:
+                    end = inc_days(other[1][1], -1)
+                    start = el[1][1]
+                    delta, value = company.impute_period(el, other, -1, average)
+                    imputed.append((delta, (end, start), value, fdate))
+                # same startdate + 'other' ends before => impute later
+                if other[1][1] == el[1][1] and other[1][0] < el[1][0]:
+                    end = el[1][0]
+                    start = inc_days(other[1][0], 1)
+                    delta, value = company.impute_period(el, other, -1, average)
+                    imputed.append((delta, (end, start), value, fdate))
+
+        for other in fields:
+            # try to chain 'el' and 'other' if => 1 year or less
+            if el[0] + other[0] <= 370:
+                # 'other' startdate == ('el' enddate + 1) => chain periods
+                if other[1][1] == inc_days(el[1][0], 1):
+                    end = other[1][0]
+                    start = el[1][1]
+                    delta, value = company.impute_period(el, other, 1, average)
+                    imputed.append((delta, (end, start), value, fdate))
+
+    # remove duplicates
+    imputed = list(set(imputed))
+
+    return imputed
+
+def old_hist_quarters(hist):
+    """ hist_quarters before the first quarter per end date was kept in a
+    dict """
+
+    quarters = [el[1:] for el in filter(lambda x: x[0] < 100, hist)]
+    enddates = list(set(map(lambda x: x[0][0], quarters)))
+
+    results = []
+    for enddate in enddates:
+        results.append(filter(lambda x: x[0][0]==enddate, quarters)[0])
+
+    return results
+
+def samples():
+    """ {'fdate|url': fields} for the sample instances """
+
+    filings = {}
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, '*.xml'))):
+        url = 'file://' + path
+        fields = fins.Filing(url, stream=True).fields
+        fdate = inc_days(fields['asof'], 30)
+        filings["{}|{}".format(fdate, url)] = fields
+
+    return filings
+
+def synthetic(years, seed=0):
+    """ {'fdate|url': fields} for 'years' fiscal years ending in September
+    (2012 and back, before the samples), quarters of 13 weeks """
+
+    rng = random.Random(seed)
+    # quarter (end, start) periods, oldest first, with per-query values
+    fy_end = datetime.date(2012, 9, 29)
+    quarters = []
+    for week in xrange(13 * 4 * (years + 2), 0, -13):
+        end = fy_end - datetime.timedelta(weeks=week - 13)
+        start = end - datetime.timedelta(days=7 * 13 - 1)
+        quarters.append(((end.strftime(DFMT), start.strftime(DFMT)),
+            [rng.randint(10, 60) * 1e8, rng.randint(900, 950) * 1e6,
+            rng.randint(100, 900) / 100.]))
+
+    def span(first, last):
+        """ the period from quarters[first] to quarters[last] and its
+        values: summed, or share-weighted for the average """
+
+        period = (quarters[last][0][0], quarters[first][0][1])
+        parts = [values for q, values in quarters[first:last + 1]]
+        shares = sum(values[1] for values in parts) / len(parts)
+        return period, [sum(values[0] for values in parts), shares,
+            sum(values[2] for values in parts)]
+
+    filings = {}
+    for fy in xrange(2, years + 2):
+        for q in xrange(4):
+            ix = 4 * fy + q
+            periods = [span(ix, ix), span(ix - 4, ix - 4)]
+            if q == 3: # 10-K: three fiscal years, then the fourth quarter
+                periods = [span(ix - 3 - 4 * back, ix - 4 * back)
+                    for back in xrange(3)] + periods[:1]
+            elif q:
+                periods += [span(ix - q, ix), span(ix - q - 4, ix - 4)]
+            asof = quarters[ix][0][0]
+            url = "synthetic/{}-{}.xml".format(asof, 'k' if q == 3 else 'q')
+            fields = dict((query, [(period, values[jx])
+                for period, values in periods])
+                for jx, query in enumerate(QUERIES))
+            fields['asof'] = asof
+            filings["{}|{}".format(inc_days(asof, 30), url)] = fields
+
+    return filings
+
+def raw_hist(company, query):
+    """ hist_fields(query) before imputation """
+
+    hist = []
+    for key, value in company.filings.items():
+        fdate = key.split("|")[0]
+        hist += [(company.per_to_delta(el[0]),) + el + (fdate,)
+            for el in value[query]]
+
+    return hist
+
+def timed(func, *args):
+    """ (seconds, result) """
+
+    start = time.time()
+    result = func(*args)
+
+    return time.time() - start, result
+
+if __name__ == '__main__':
+    spans = [int(arg) for arg in sys.argv[1:]] or [0, 3, 20]
+
+    fetch.cache.enabled = False
+    sampled = samples()
+    print "{:<6} {:<30} {:>6} {:>8} {:>10} {:>10}".format('years', 'query',
+        'facts', 'imputed', 'old', 'indexed')
+    for years in spans:
+        filings = dict(sampled, **synthetic(years))
+        company = new.instance(fins.Company, dict(filings=filings))
+        for query in QUERIES:
+            average = 'average' in query.lower()
+            hist = raw_hist(company, query)
+            old_s, old = timed(old_impute_periods, company, hist, average)
+            new_s, imputed = timed(company.impute_periods, hist, average)
+            assert imputed == old, "imputed periods differ: {}".format(query)
+            assert company.hist_fields(query) == hist + old
+            assert sorted(company.hist_quarters(query)) == \
+                sorted(old_hist_quarters(hist + old)), \
+                "quarters differ: {}".format(query)
+            print "{:<6} {:<30} {:>6} {:>8} {:>9.4f}s {:>9.4f}s".format(years,
+                query, len(hist), len(imputed), old_s, new_s)
@@ -0,0 +1,125 @@
+""" Facts/second of XBRL instance parsing: the old per-fact context lookup
+(root.find for each fact's contextRef) against fins.Filing's context index
+(get_instances) and streaming parse (stream_instances).
+
+Each sample instance in data/ is parsed as is and scaled up by 'copies':
+its contexts and facts repeated under new context ids, as a large 10-K
+has thousands of contexts. All parses must yield the same facts.
+
+    python benchmarks/instances.py [copies] [files...]
+"""
+
+import glob
+import new
+import os
+import re
+import StringIO
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fins
+
+DATA_DIR = os.path.join(HERE, 'data')
+BODY_P = re.compile(r'(<xbrli:context[\s\S]*</xbrli:context>\s*)([\s\S]*?)'
+    r'(\s*<xbrli:unit[\s\S]*?</xbrli:unit>\s*)+([\s\S]*)(</xbrli:xbrl>)')
+
+def scale(data, copies):
+    """ data with its contexts and unit-bearing facts repeated 'copies'
+    times, context ids suffixed _1, _2... in each repeat """
+
+    if copies <= 1:
+        return data
+
+    match = BODY_P.search(data)
+    contexts, facts = match.group(1), match.group(4)
+    facts = ''.join(line for line in facts.splitlines(True)
+        if 'unitRef' in line)
+    extra_contexts, extra_facts = [], []
+    for copy in xrange(1, copies):
+        suffix = '_{}"'.format(copy)
+        extra_contexts.append(re.sub(r'(<xbrli:context id="[^"]*)"',
+            r'\1' + suffix, contexts))
+        extra_facts.append(re.sub(r'(contextRef="[^"]*)"', r'\1' + suffix,
+            facts))
+
+    return (data[:match.start(4)].replace(contexts, contexts +
+        ''.join(extra_contexts), 1) + match.group(4) + ''.join(extra_facts) +
+        match.group(5))
+
+def old_instances(root):
+    """ get_instances before the context index: a root.find per fact """
+
+    instances = []
+    for node in root.iter():
+        if node.attrib.has_key('unitRef') and node.text:
+            name = node.tag.split('}')[-1]
+            value = float(node.text)
+            period, segment = [], ''
+            context = root.find("*[@id='{}']".format(node.attrib['contextRef']))
+            for el in context.iter():
+                if el.tag.endswith("explicitMember"):
+                    segment = el.text
+                if el.tag.endswith("instant"):
+                    period = [el.text.strip(), el.text.strip()]
+                if el.tag.endswith("startDate"):
+                    period.append(el.text.strip())
+                if el.tag.endswith("endDate"):
+                    period.insert(0, el.text.strip())
+            instances.append((name, tuple(period), value, segment))
+
+    return instances
+
+def _filing():
+    filing = new.instance(fins.Filing)
+    filing.fields = {}
+    return filing
+
+def indexed_instances(root):
+
+    filing = _filing()
+    filing.root = root
+    filing.get_instances()
+
+    return filing.instances.rows()
+
+def streamed_instances(data):
+
+    return list(_filing().stream_instances(StringIO.StringIO(data)))
+
+def timed(func, arg, repeat=3):
+    """ (best seconds of repeat calls, result) """
+
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+if __name__ == '__main__':
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    paths = sys.argv[2:] or sorted(glob.glob(os.path.join(DATA_DIR, '*.xml')))
+
+    print "{:<28} {:>7} {:>8} {:>12} {:>12} {:>12}".format('instance',
+        'facts', 'contexts', 'old f/s', 'indexed f/s', 'streamed f/s')
+    for path in paths:
+        with open(path) as f:
+            sample = f.read()
+        for n in sorted(set([1, copies])):
+            data = scale(sample, n)
+            root = ET.fromstring(data)
+            old_s, old = timed(old_instances, root, 1)
+            indexed_s, indexed = timed(indexed_instances, root)
+            streamed_s, streamed = timed(streamed_instances, data)
+            assert old == indexed == streamed, "parses differ: " + path
+            contexts = len([node for node in root
+                if node.tag.endswith('}context')])
+            print "{:<28} {:>7,} {:>8,} {:>12,.0f} {:>12,.0f} {:>12,.0f}".format(
+                "{} x{}".format(os.path.basename(path)[:-4], n), len(old),
+                contexts, len(old) / old_s, len(old) / indexed_s,
+                len(old) / streamed_s)
@@ -0,0 +1,105 @@
+""" fins.Company's concurrent fetch pipeline against a stub EDGAR (see
+stub_edgar.py): a company with 'filings' 10-Q filings, each response
+delayed 'latency' seconds, is built with one worker and with 'workers'
+workers under the per-host rate limit 'rate' (requests per second).
+
+Both builds must list the same filings and fields in the same order, no
+one-second window may see more than rate requests (plus one, for a
+request on the window's edge), and the concurrent build must be faster.
+Instances are the samples in data/; the disk cache and the local catalog
+are left out so every document is fetched.
+
+    python benchmarks/rate_limit.py [filings] [workers] [rate] [latency]
+"""
+
+import datetime
+import glob
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ['OPENSEC_CATALOG'] = os.path.join(tempfile.mkdtemp(), 'none.db')
+import fetch
+import fins
+import stub_edgar
+
+DATA_DIR = os.path.join(HERE, 'data')
+CIK = '0000320193'
+BROWSE_ROW = ('<tr><td nowrap="nowrap">10-Q</td><td><a href="{index}" '
+    'id="documentsbutton">Documents</a> <a href="#" id="interactiveDataBtn">'
+    'Interactive Data</a></td><td>{date}</td></tr>\n')
+
+def edgar(count):
+    """ pages(path, query) for a company with count 10-Q filings, newest
+    first, and the filing dates expected in that order """
+
+    samples = dict((os.path.basename(path), open(path).read())
+        for path in glob.glob(os.path.join(DATA_DIR, '*.xml')))
+    names = sorted(samples)
+    pages, dates, rows = {}, [], []
+    for ix in xrange(count):
+        date = (datetime.date(2014, 1, 28) -
+            datetime.timedelta(days=91 * ix)).isoformat()
+        acc = "0001193125-{:02d}-{:06d}".format(14 - ix // 4, ix)
+        folder = "/Archives/edgar/data/{}/{}".format(int(CIK),
+            acc.replace('-', ''))
+        instance = "{}/{}".format(folder, names[ix % len(names)])
+        index = "{}/{}-index.htm".format(folder, acc)
+        pages[index] = '<a href="{}">instance</a>'.format(instance)
+        pages[instance] = samples[names[ix % len(names)]]
+        rows.append(BROWSE_ROW.format(index=index, date=date))
+        dates.append(date)
+
+    def page(path, query):
+        if path.endswith('browse-edgar/'):
+            listed = rows if query.get('type') == ['10-'] else []
+            return ('<span class="companyName">APPLE INC CIK#: '
+                '<a href="?CIK={}">x</a></span><table>{}</table>'.format(CIK,
+                ''.join(listed)))
+        return pages.get(path)
+
+    return page, dates
+
+def build(server, workers, rate):
+    """ (seconds, Company) for a cold build on 'workers' threads """
+
+    fetch.limiter = fetch.RateLimiter(rate)
+    server.reset()
+    start = time.time()
+    company = fins.Company('AAPL', workers)
+
+    return time.time() - start, company
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    count = int(args[0]) if len(args) > 0 else 12
+    workers = int(args[1]) if len(args) > 1 else fetch.WORKERS
+    rate = float(args[2]) if len(args) > 2 else fetch.SEC_RATE
+    latency = float(args[3]) if len(args) > 3 else 0.3
+
+    fetch.cache.enabled = False
+    page, dates = edgar(count)
+    with stub_edgar.StubServer(page, latency) as server:
+        fins.ROOT = server.url + '/'
+        serial_s, serial = build(server, 1, rate)
+        pooled_s, pooled = build(server, workers, rate)
+        arrivals = server.reset()
+
+    requests = len(arrivals)
+    busiest = stub_edgar.max_per_second([at for at, path in arrivals])
+    print "{} filings, {} requests, {}s latency, {} req/s limit".format(count,
+        requests, latency, rate)
+    print "{:<12} {:>8.2f}s".format("1 worker", serial_s)
+    print "{:<12} {:>8.2f}s {:>6.1f}x, busiest second {} requests".format(
+        "{} workers".format(workers), pooled_s, serial_s / pooled_s, busiest)
+
+    assert [date for asof, date in pooled.meta['filing_dates']] == dates, \
+        "filings out of order"
+    assert pooled.meta['filing_dates'] == serial.meta['filing_dates']
+    assert pooled.filings == serial.filings, "parsed fields differ"
+    assert requests == 2 * count + 2, "expected one fetch per document"
+    assert busiest <= rate + 1, "rate limit exceeded"
+    assert pooled_s < serial_s, "no faster with {} workers".format(workers)
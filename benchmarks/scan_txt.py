@@ -0,0 +1,123 @@
+""" Lines/second of text (pre-2013) 13F parsing, crawler.scan_txt against
+the parser it replaced, which re-ran its patterns on every line and
+searched back over skipped lines for wrapped issuer names.
+
+Both parsers must give the same holdings and reported totals for each
+filing in data/13f-txt. Each filing's table is also repeated 'copies'
+times for throughput on long documents, as large managers file.
+
+    python benchmarks/scan_txt.py [copies] [files...]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import crawler
+
+DATA_DIR = os.path.join(HERE, 'data', '13f-txt')
+
+def old_scan_txt(lines):
+    """ crawl_txt's parse before scan_txt, for lines of a text filing """
+
+    mv_rep = ct_rep = None
+    last_used = 0
+    holdings = []
+    cus_re = r'((?:[a-zA-Z]\w{2}\d)|(?:9\w{3})|(?:0[a-zA-Z]\d\d)|\d{4})(\w{2}[-\s]?\w{2}[-\s]?\d)\s'
+    cusip_p = re.compile(cus_re)
+    numer_p = re.compile(r'-|\d+,?\d*,?\d*(?:.00)?')
+    option_p = re.compile('CALL|PUT', re.IGNORECASE)
+    issuer_p = re.compile(r'\s*\w+\s')
+    head_p = re.compile(r'ISSUER', re.IGNORECASE)
+
+    for index, line in enumerate(lines):
+        try:
+            issuer = cusip = value = shares = option = None
+            match = re.search('Information Table Entry Total:[\s$]*([\d,]+)',
+                              line)
+            if match: ct_rep = int(''.join(match.groups()).replace(',',''))
+            match = re.search('Information Table Value Total:[\s$]*([\d,]+)',
+                              line)
+            if match: mv_rep = int(''.join(match.groups()).replace(',',''))
+            match = cusip_p.search(line)
+            if match:
+                cusip = ''.join(match.groups())
+
+                issuer = line[:match.start()].strip()
+                for delim in ['  ', '...', '\t']:
+                    issuer = issuer.split(delim)[0]
+                issuer = issuer.strip()
+                if issuer[:2] == "D ":
+                    issuer = issuer[2:]
+
+                for skipped in range(index - 1, last_used, - 1):
+                    frag = lines[skipped]
+                    if cusip_p.search(frag) or head_p.search(frag) or not issuer_p.search(frag):
+                        break
+
+                    frag = frag.strip()
+                    for delim in ['  ', '...', '\t']:
+                        frag = frag.split(delim)[0]
+                    issuer = frag + ' ' + issuer
+
+                remainder = line[match.end():]
+
+                match = numer_p.search(remainder)
+                if match:
+                    value = int(match.group().replace(',','').replace('-','0'))
+                    match = numer_p.search(remainder[match.end():])
+                    if match:
+                        shares = match.group()
+                        for old, new in ((',', ''), ('.00', ''), ('-', '0')):
+                            shares = shares.replace(old, new)
+                        shares = int(shares)
+                        match = option_p.search(remainder[match.end():])
+                        if match:
+                            option = match.group()
+
+                if value:
+                    holdings.append([issuer, cusip, value, shares, option])
+                    last_used = index
+
+        except ValueError:
+            continue
+
+    return holdings, mv_rep, ct_rep
+
+def repeat(lines, copies):
+    """ lines with the table (after the first 'Information Table' total)
+    repeated copies times """
+
+    start = max(ix for ix, line in enumerate(lines)
+        if 'Information Table' in line) + 1
+
+    return lines[:start] + lines[start:] * copies
+
+def lines_per_second(func, lines):
+
+    start = time.time()
+    result = func(lines)
+
+    return len(lines) / max(time.time() - start, 1e-6), result
+
+if __name__ == '__main__':
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    paths = sys.argv[2:] or sorted(glob.glob(os.path.join(DATA_DIR, '*.txt')))
+
+    print "{:<26} {:>8} {:>8} {:>12} {:>12}".format('filing', 'lines',
+        'holdings', 'old lines/s', 'new lines/s')
+    for path in paths:
+        with open(path) as f:
+            sample = f.read().split('\n')
+        for n in sorted(set([1, copies])):
+            lines = repeat(sample, n)
+            old_rate, old = lines_per_second(old_scan_txt, lines)
+            new_rate, new = lines_per_second(crawler.scan_txt, lines)
+            assert old == new, "parsers differ: {} x{}".format(path, n)
+            print "{:<26} {:>8,} {:>8,} {:>12,.0f} {:>12,.0f}".format(
+                "{} x{}".format(os.path.basename(path)[:-4], n), len(lines),
+                len(new[0]), old_rate, new_rate)
@@ -0,0 +1,79 @@
+""" Local stand-in for www.sec.gov for the end-to-end checks: a threaded
+HTTP server answering GETs from a function of the path and query, after a
+fixed latency, and recording when each request arrived.
+
+    server = StubServer(lambda path, query: pages.get(path), latency=0.1)
+    with server:
+        fetch.get(server.url + '/Archives/...')
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import urlparse
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+class StubServer:
+    """ Serves pages(path, query) (query as from urlparse.parse_qs); None
+    answers 404. arrivals lists (time, path) of each request. """
+
+    def __init__(self, pages, latency=0.):
+
+        self.pages = pages
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.arrivals = []
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.arrivals.append((time.time(), self.path))
+                parsed = urlparse.urlparse(self.path)
+                body = stub.pages(parsed.path, urlparse.parse_qs(parsed.query))
+                time.sleep(stub.latency)
+                self.send_response(404 if body is None else 200)
+                self.end_headers()
+                self.wfile.write('not found' if body is None else body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def __enter__(self):
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        """ Clears arrivals, returning them """
+
+        with self.lock:
+            arrivals, self.arrivals = self.arrivals, []
+        return arrivals
+
+def max_per_second(times):
+    """ Most of times (seconds) falling within any one second """
+
+    times = sorted(times)
+    most = lo = 0
+    for hi, end in enumerate(times):
+        while end - times[lo] >= 1:
+            lo += 1
+        most = max(most, hi - lo + 1)
+
+    return most
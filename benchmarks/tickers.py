@@ -0,0 +1,206 @@
+""" Throughput of main.resolve_tickers on a synthetic 5,000-row 13F filing
+against the old per-holding path (a datastore query per row, then on a
+miss a cusip_to_ticker call and a put per security).
+
+The datastore and the lookup service are in-memory stand-ins that sleep
+for each round trip ('rpc' and 'lookup' seconds); ndb async queries run
+on threads. main is imported for resolve_tickers, so the App Engine SDK
+(webapp2, google.appengine) must be importable:
+
+    PYTHONPATH=$SDK:$SDK/lib/webapp2-2.5.2 python benchmarks/tickers.py
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+try:
+    import main
+except ImportError as e:
+    sys.exit("{}: needs the App Engine SDK on the path, e.g.\n"
+        "    PYTHONPATH=$SDK:$SDK/lib/webapp2-2.5.2 python "
+        "benchmarks/tickers.py".format(e))
+
+RPC = 0.002 # seconds per datastore round trip
+LOOKUP = 0.005 # seconds per cusip_to_ticker call
+
+class Datastore:
+    """ Security rows by cusip: 'keyed' ones have the cusip as key id, the
+    rest were saved before that and are only found by query """
+
+    def __init__(self, keyed, unkeyed):
+
+        self.keyed, self.unkeyed = dict(keyed), dict(unkeyed)
+        self.rpcs = 0
+        self.lock = threading.Lock()
+
+    def rpc(self):
+
+        with self.lock:
+            self.rpcs += 1
+        time.sleep(RPC)
+
+class Key:
+
+    def __init__(self, kind, id=None, parent=None):
+        self.id = id
+
+class Future:
+    """ Runs func on a thread, as an ndb async call returns at once """
+
+    def __init__(self, func):
+
+        self.thread = threading.Thread(target=self.run, args=(func,))
+        self.thread.start()
+
+    def run(self, func):
+        self.result = func()
+
+    def get_result(self):
+
+        self.thread.join()
+        return self.result
+
+class Property:
+
+    def IN(self, values):
+        return set(values)
+
+    def __eq__(self, value):
+        return set([value])
+
+def fake_ndb(store):
+    """ (ndb, Security) stand-ins backed by store """
+
+    class Security:
+        cusip = Property()
+
+        def __init__(self, id=None, parent=None, cusip=None, ticker=None):
+            self.id, self.ticker = id, ticker
+            self.__dict__['cusip'] = cusip
+
+        @classmethod
+        def query(cls, cusips, ancestor=None):
+            return Query(cls, cusips)
+
+        def put(self):
+            store.rpc()
+            store.keyed[self.id] = self.ticker
+
+    class Query:
+
+        def __init__(self, cls, cusips):
+            self.cls, self.cusips = cls, cusips
+
+        def fetch(self, limit=None):
+            store.rpc()
+            found = dict(store.unkeyed)
+            found.update(store.keyed)
+            return [self.cls(cusip=cusip, ticker=ticker)
+                for cusip, ticker in found.items() if cusip in self.cusips]
+
+        def fetch_async(self, limit=None):
+            return Future(self.fetch)
+
+        def get(self):
+            results = self.fetch()
+            return results[0] if results else None
+
+    class ndb:
+        Key = Key
+
+        @staticmethod
+        def get_multi(keys):
+            store.rpc()
+            return [Security(id=key.id, cusip=key.id,
+                ticker=store.keyed[key.id]) if key.id in store.keyed else None
+                for key in keys]
+
+        @staticmethod
+        def put_multi(entities):
+            store.rpc()
+            for entity in entities:
+                store.keyed[entity.id] = entity.ticker
+
+    return ndb, Security
+
+def cusip_to_ticker(known):
+
+    def lookup(cusip):
+        time.sleep(LOOKUP)
+        return known.get(cusip, '')
+
+    return lookup
+
+def old_resolve(cusips, Security, lookup):
+    """ clean_filing's lookups before resolve_tickers, one row at a time """
+
+    tickers = {}
+    for cusip in cusips:
+        security = Security.query(Security.cusip == cusip).get()
+        if security:
+            tickers[cusip] = security.ticker
+        else:
+            tickers[cusip] = lookup(cusip)
+            if tickers[cusip]:
+                Security(id=cusip, cusip=cusip, ticker=tickers[cusip]).put()
+
+    return tickers
+
+def synthetic(rows=5000, unique=2600, seed=1):
+    """ (cusips of a rows-long filing, keyed rows, unkeyed rows, tickers
+    the lookup service knows): half the unique cusips are in the
+    datastore (a fifth of those unkeyed), 40% found by lookup and the
+    rest unknown """
+
+    rand = random.Random(seed)
+    universe = ["{:08d}{}".format(ix * 7919 % 10**8, ix % 10)
+        for ix in xrange(unique)]
+    tickers = dict((cusip, "T{}".format(ix))
+        for ix, cusip in enumerate(universe))
+    stored = universe[:unique // 2]
+    unkeyed = dict((cusip, tickers[cusip]) for cusip in stored[::5])
+    keyed = dict((cusip, tickers[cusip]) for cusip in stored
+        if cusip not in unkeyed)
+    known = dict((cusip, tickers[cusip])
+        for cusip in universe[unique // 2:unique * 9 // 10])
+    cusips = universe + [rand.choice(universe) for ix in xrange(rows - unique)]
+    rand.shuffle(cusips)
+
+    return cusips, keyed, unkeyed, known
+
+def run(label, func, cusips, store):
+
+    start, rpcs = time.time(), store.rpcs
+    tickers = func(cusips)
+    elapsed = time.time() - start
+    print "{:<22} {:>8.2f}s {:>10,.0f} rows/s {:>7,} rpcs".format(label,
+        elapsed, len(cusips) / elapsed, store.rpcs - rpcs)
+
+    return tickers
+
+if __name__ == '__main__':
+    cusips, keyed, unkeyed, known = synthetic()
+    print "{:,} rows, {:,} unique cusips; rpc {}s, lookup {}s".format(
+        len(cusips), len(set(cusips)), RPC, LOOKUP)
+    lookup = cusip_to_ticker(known)
+    main.MASTER = None
+    main.stocks.cusip_to_ticker = lookup
+
+    store = Datastore(keyed, unkeyed)
+    ndb, Security = fake_ndb(store)
+    old = run("old, cold", lambda c: old_resolve(c, Security, lookup),
+        cusips, store)
+
+    store = Datastore(keyed, unkeyed)
+    main.ndb, main.Security = fake_ndb(store)
+    main.TICKER_CACHE = main.fetch.LRUCache(50000)
+    new = run("batched, cold", main.resolve_tickers, cusips, store)
+    main.TICKER_CACHE = main.fetch.LRUCache(50000) # new process
+    run("batched, datastore", main.resolve_tickers, cusips, store)
+    run("batched, LRU", main.resolve_tickers, cusips, store)
+    assert old == new, "resolved tickers differ"
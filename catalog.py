@@ -0,0 +1,265 @@
+""" Local catalog of EDGAR filings built from the quarterly full-index files
+(form.idx or master.idx, optionally gzipped), so filing lists can be looked
+up by CIK, form type and date without scraping browse-edgar.
+
+    python catalog.py path/to/full-index [catalog.db]
+"""
+
+import gzip
+import logging
+import os
+import re
+import sys
+
+try:
+    import sqlite3
+    DB_ERRORS = (sqlite3.Error,)
+except ImportError: # e.g. the App Engine runtime: lookups find nothing and
+    sqlite3 = None  # callers fall back to browse-edgar
+    DB_ERRORS = ()
+
+
+# CONSTANTS
+CATALOG_PATH = os.environ.get('OPENSEC_CATALOG',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.db'))
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS filings (
+        cik INTEGER NOT NULL, company TEXT, form TEXT NOT NULL,
+        date TEXT NOT NULL, filename TEXT PRIMARY KEY, accession TEXT);
+    CREATE TABLE IF NOT EXISTS tickers (
+        ticker TEXT PRIMARY KEY, cik INTEGER NOT NULL);
+"""
+INDEXES = """
+    CREATE INDEX IF NOT EXISTS filings_cik ON filings (cik, form, date);
+    CREATE INDEX IF NOT EXISTS filings_form ON filings (form, date);
+    CREATE INDEX IF NOT EXISTS filings_accession ON filings (accession);
+"""
+# catalogs built before the accession column get it from the filename's
+# last path segment ('edgar/data/1/0001193125-14-052159.txt')
+MIGRATE = """
+    ALTER TABLE filings ADD COLUMN accession TEXT;
+    UPDATE filings SET accession = replace(substr(filename,
+        length(rtrim(filename, replace(filename, '/', ''))) + 1), '.txt', '');
+"""
+INSERT = ("INSERT OR IGNORE INTO filings (cik, company, form, date, filename, "
+    "accession) VALUES (?, ?, ?, ?, ?, ?)")
+BATCH = 50000 # rows per executemany while ingesting
+
+def connect(path=CATALOG_PATH, create=False):
+    """Returns sqlite3 connection to the catalog, or None if sqlite3 is
+    unavailable or the catalog hasn't been built (unless create)"""
+
+    if sqlite3 is None or not (create or os.path.exists(path)):
+        return None
+
+    db = sqlite3.connect(path)
+    db.text_factory = str
+    if create:
+        db.executescript(SCHEMA)
+        columns = [row[1] for row in db.execute("PRAGMA table_info(filings)")]
+        if 'accession' not in columns:
+            db.executescript(MIGRATE)
+        db.executescript(INDEXES)
+
+    return db
+
+def filename_accession(filename):
+    """'edgar/data/1/0001193125-14-052159.txt' => '0001193125-14-052159',
+    or None if filename isn't named by accession number"""
+
+    match = re.search(r'/(\d{10}-\d{2}-\d{6})\.txt$', filename)
+
+    return match and match.group(1)
+
+def parse_index(lines):
+    """Parses a full-index file
+    INPUT: lines of form.idx (fixed-width columns) or master.idx ('|'
+    delimited)
+    OUTPUT: yields (cik, company, form, date, filename) tuples"""
+
+    columns = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if columns is None:
+            # Header ends at the dashed line; form.idx column offsets come
+            # from the header labels
+            if line.startswith('Form Type') and 'File Name' in line:
+                columns = [line.index(label) for label in ('Form Type',
+                    'Company Name', 'CIK', 'Date Filed', 'File Name')]
+            elif line.startswith('CIK|'):
+                columns = '|'
+            continue
+        if not line or line.startswith('---'):
+            continue
+
+        if columns == '|':
+            fields = line.split('|')
+            if len(fields) != 5:
+                continue
+            cik, company, form, date, filename = fields
+        else:
+            # the CIK column can overflow into the date column, so read the
+            # trailing columns from the right
+            form = line[:columns[1]].strip()
+            company = line[columns[1]:columns[2]].strip()
+            tail = line[columns[2]:].split()
+            if len(tail) < 3:
+                continue
+            cik, date, filename = tail[-3:]
+
+        if not cik.isdigit():
+            continue
+        if len(date) == 8 and date.isdigit(): # older files use YYYYMMDD
+            date = "{}-{}-{}".format(date[:4], date[4:6], date[6:])
+
+        yield int(cik), company.strip(), form.strip(), date, filename.strip()
+
+def index_files(directory):
+    """Full-index files (form.idx, master.idx, or .gz) under directory.
+    Prefers master.idx over form.idx when a quarter has both."""
+
+    found = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        names = set(filenames)
+        for name in ('master.idx', 'master.idx.gz', 'form.idx', 'form.idx.gz'):
+            if name in names:
+                found.append(os.path.join(dirpath, name))
+                break
+
+    return sorted(found)
+
+def ingest(paths, path=CATALOG_PATH):
+    """Streams full-index files into the catalog in one transaction;
+    filings already in the catalog are skipped. A catalog from before the
+    accession column is migrated first.
+    OUTPUT: number of index rows read"""
+
+    db = connect(path, create=True)
+    if db is None:
+        raise RuntimeError("sqlite3 is unavailable; can't build the catalog")
+    count = 0
+    with db:
+        for index_path in paths:
+            opener = gzip.open if index_path.endswith('.gz') else open
+            with opener(index_path, 'rb') as f:
+                rows = []
+                for row in parse_index(f):
+                    rows.append(row + (filename_accession(row[4]),))
+                    if len(rows) >= BATCH:
+                        db.executemany(INSERT, rows)
+                        count += len(rows)
+                        rows = []
+                db.executemany(INSERT, rows)
+                count += len(rows)
+    db.close()
+
+    return count
+
+def filings(cik, form, since=None, limit=100, path=CATALOG_PATH):
+    """Filings for cik with form type starting with form (e.g. '13F-HR',
+    '10-'), newest first, as browse-edgar lists them
+    OUTPUT: list of (date, form, company, filename); empty if no catalog"""
+
+    try:
+        db = connect(path)
+        if db is None:
+            return []
+        query = ("SELECT date, form, company, filename FROM filings "
+            "WHERE cik = ? AND form >= ? AND form < ? AND date >= ? "
+            "ORDER BY date DESC, filename DESC LIMIT ?")
+        # prefix match as a range so the (cik, form, date) index is used
+        results = db.execute(query, (int(cik), form, form + '\xff',
+            since or '', limit)).fetchall()
+        db.close()
+    except DB_ERRORS as e:
+        logging.warning("catalog lookup failed: %s", e)
+        return []
+
+    return results
+
+def form_filings(form, since, until, path=CATALOG_PATH):
+    """All filings with form type starting with form filed from since up to
+    (not including) until, oldest first
+    OUTPUT: list of (date, form, company, filename); empty if no catalog"""
+
+    try:
+        db = connect(path)
+        if db is None:
+            return []
+        query = ("SELECT date, form, company, filename FROM filings "
+            "WHERE form >= ? AND form < ? AND date >= ? AND date < ? "
+            "ORDER BY date, filename")
+        results = db.execute(query, (form, form + '\xff', since,
+            until)).fetchall()
+        db.close()
+    except DB_ERRORS as e:
+        logging.warning("catalog lookup failed: %s", e)
+        return []
+
+    return results
+
+def accession_filename(accession, path=CATALOG_PATH):
+    """Filename of the filing with accession number accession (e.g.
+    '0001193125-14-052159'), or None if it isn't in the catalog"""
+
+    try:
+        db = connect(path)
+        if db is None:
+            return None
+        row = db.execute("SELECT filename FROM filings WHERE accession = ?",
+            (accession,)).fetchone()
+        db.close()
+    except DB_ERRORS as e: # e.g. catalog predates accession; re-ingest
+        logging.warning("catalog lookup failed: %s", e)
+        return None
+
+    return row and row[0]
+
+def ticker_cik(ticker, path=CATALOG_PATH):
+    """CIK recorded for ticker by set_ticker, or None"""
+
+    try:
+        db = connect(path)
+        if db is None:
+            return None
+        row = db.execute("SELECT cik FROM tickers WHERE ticker = ?",
+            (ticker.upper(),)).fetchone()
+        db.close()
+    except DB_ERRORS:
+        return None
+
+    return row and row[0]
+
+def set_ticker(ticker, cik, path=CATALOG_PATH):
+    """Records ticker => cik (learned from a browse-edgar page) if the
+    catalog exists"""
+
+    try:
+        db = connect(path)
+        if db is None:
+            return
+        with db:
+            db.execute("INSERT OR REPLACE INTO tickers VALUES (?, ?)",
+                (ticker.upper(), int(cik)))
+        db.close()
+    except DB_ERRORS as e:
+        logging.warning("catalog not updated: %s", e)
+
+def index_slug(filename):
+    """'edgar/data/1/0001193125-14-052159.txt' =>
+    '/Archives/edgar/data/1/000119312514052159/0001193125-14-052159-index.htm'
+    (the filing index page browse-edgar links to)"""
+
+    match = re.match(r'(edgar/data/\d+)/(\d{10}-\d{2}-\d{6})\.txt$', filename)
+    if not match:
+        return "/Archives/{}".format(filename)
+    folder, accession = match.groups()
+
+    return "/Archives/{}/{}/{}-index.htm".format(folder,
+        accession.replace('-', ''), accession)
+
+if __name__ == '__main__':
+    paths = index_files(sys.argv[1])
+    args = sys.argv[2:3]
+    print "{} index rows read from {} files".format(ingest(paths, *args),
+        len(paths))
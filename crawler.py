@@ -1,130 +1,164 @@
-from xml.dom import minidom
-
+import logging
 import urllib
-from google.appengine.api import urlfetch
+import urlparse
 import re
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import catalog
+import fetch
+import holders
         
+#Patterns for text (pre-2013) information tables, compiled once
+CUSIP_P = re.compile(r'((?:[a-zA-Z]\w{2}\d)|(?:9\w{3})|(?:0[a-zA-Z]\d\d)|\d{4})(\w{2}[-\s]?\w{2}[-\s]?\d)\s')
+#old cusip re: r'(\w{6})[-\s]?(\w{2})[-\s]?(\d)\s'
+NUMER_P = re.compile(r'-|\d+,?\d*,?\d*(?:.00)?')
+OPTION_P = re.compile('CALL|PUT', re.IGNORECASE)
+ISSUER_P = re.compile(r'\s*\w+\s')
+HEAD_P = re.compile(r'ISSUER', re.IGNORECASE)
+DELIM_P = re.compile(r'  |\.\.\.|\t') #issuer name ends at first of these
+COUNT_P = re.compile(r'Information Table Entry Total:[\s$]*([\d,]+)')
+TOTAL_P = re.compile(r'Information Table Value Total:[\s$]*([\d,]+)')
+ACCESSION_P = re.compile(r'\d{10}-\d{2}-\d{6}')
+
 def crawl_txt(filing_url):
 
     url = filing_url.replace("-index.html",".txt").replace("-index.htm",".txt")
-    r = urlfetch.fetch(url).content
-    lines = r.split('\n')
+    r = fetch.get(url)
+
+    return scan_txt(r.split('\n'))
+
+def scan_txt(lines):
     #INPUT: list of lines of text leading to filing in .txt format
     #OUTPUT: list of holdings as list and reported total mkt val and count
-    #Looks for a CUSIP using a regexp and builds the line off that
+    #Looks for a CUSIP using a regexp and builds the line off that.
+    #Single pass: lines that may be the start of an issuer name breaking
+    #onto 2+ lines are carried forward in 'pending' until the next holding
     mv_rep = ct_rep = None
-    last_used = 0
     holdings = []
-    cus_re = r'((?:[a-zA-Z]\w{2}\d)|(?:9\w{3})|(?:0[a-zA-Z]\d\d)|\d{4})(\w{2}[-\s]?\w{2}[-\s]?\d)\s'
-    #old cusip re: r'(\w{6})[-\s]?(\w{2})[-\s]?(\d)\s'
-    cusip_p = re.compile(cus_re)
-    numer_p = re.compile(r'-|\d+,?\d*,?\d*(?:.00)?')
-    option_p = re.compile('CALL|PUT', re.IGNORECASE)
-    issuer_p = re.compile(r'\s*\w+\s')
-    head_p = re.compile(r'ISSUER', re.IGNORECASE)
+    pending = []
     
     for index, line in enumerate(lines):
+        cusip_match = CUSIP_P.search(line)
         try:
             issuer = cusip = value = shares = option = None
             #Get reported positions count and total mv
-            match = re.search('Information Table Entry Total:[\s$]*([\d,]+)',
-                              line)
-            if match: ct_rep = int(''.join(match.groups()).replace(',',''))
-            match = re.search('Information Table Value Total:[\s$]*([\d,]+)',
-                              line)
-            if match: mv_rep = int(''.join(match.groups()).replace(',',''))
+            if 'Information Table' in line:
+                match = COUNT_P.search(line)
+                if match: ct_rep = int(''.join(match.groups()).replace(',',''))
+                match = TOTAL_P.search(line)
+                if match: mv_rep = int(''.join(match.groups()).replace(',',''))
             #TODO: below RE needs to exclude where preceded by "CIK", "IRS"
             #Current version catches "NASDAQ 100"
-            match = cusip_p.search(line)
+            match = cusip_match
             if match:
                 cusip = ''.join(match.groups()) 
                 
-                issuer = line[:match.start()].strip()
-                for delim in ['  ', '...', '\t']:
-                    issuer = issuer.split(delim)[0]
+                issuer = DELIM_P.split(line[:match.start()].strip(), 1)[0]
                 issuer = issuer.strip()
                 if issuer[:2] == "D ":
                     issuer = issuer[2:]
                 
-                #Below loop checks backwards over any skipped lines for issuer
-                #name breaking onto 2 lines
-                
-                for skipped in range(index - 1, last_used, - 1):
-                    frag = lines[skipped]
-                    #Loop terminates at first preceding line that included 
-                    #a cusip or contains no text. Note: CUSIP re pattern is 
-                    #used here because it is possible that a zero-value
-                    #holding (which has a CUSIP) was skipped but won't contain title
-                    if cusip_p.search(frag) or head_p.search(frag) or not issuer_p.search(frag):
-                        break
-                    
-                    frag = frag.strip()
-                    for delim in ['  ', '...', '\t']:
-                        frag = frag.split(delim)[0]
-                    issuer = frag + ' ' + issuer                
+                #Prepend fragments of issuer name from preceding lines
+                if pending:
+                    issuer = ' '.join(pending) + ' ' + issuer
                 
                 remainder = line[match.end():]
 
-                match = numer_p.search(remainder)
+                match = NUMER_P.search(remainder)
                 if match:
                     value = int(match.group().replace(',','').replace('-','0'))
-                    match = numer_p.search(remainder[match.end():])
+                    match = NUMER_P.search(remainder[match.end():])
                     if match:
                         shares = match.group()
                         for old, new in ((',', ''), ('.00', ''), ('-', '0')):
                             shares = shares.replace(old, new)
                         shares = int(shares)
-                        match = option_p.search(remainder[match.end():])
+                        match = OPTION_P.search(remainder[match.end():])
                         if match:
                             option = match.group()
                 
                 if value:#TODO: band-aid until above REGEX change is made
                     holdings.append([issuer, cusip, value, shares, option])
-                    last_used = index
         
         except ValueError:
-            continue
+            pass
+
+        #Fragments run back to the first preceding line that included a
+        #cusip or contains no text. Note: CUSIP re pattern is used here
+        #because it is possible that a zero-value holding (which has a
+        #CUSIP) was skipped but won't contain title. The first line of the
+        #document is never a fragment.
+        if (cusip_match or not index or HEAD_P.search(line)
+                or not ISSUER_P.search(line)):
+            pending = []
+        else:
+            pending.append(DELIM_P.split(line.strip(), 1)[0])
                 
     return holdings, mv_rep, ct_rep
 
+def local_name(tag):
+    """Strips namespace from an ElementTree tag: '{uri}cusip' => 'cusip'"""
+
+    return tag.rsplit('}', 1)[-1]
+
+def iter_info_table(source):
+    """Streams holdings from an XML information table
+    INPUT: file-like source; tags may be namespaced (e.g. ns1:infoTable)
+    OUTPUT: yields [issuer, cusip, value, shares, option] per infoTable row
+    NOTES: the root's children are cleared once handled, so memory doesn't
+    grow with the number of rows. The root comes from the first 'start'
+    event; later 'start' events are skipped."""
+
+    root = None
+    for event, node in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = node
+            continue
+        if node.tag != 'infoTable' and not node.tag.endswith('}infoTable'):
+            continue
+
+        ns = node.tag[:-len('infoTable')] # '{uri}' or ''
+        issuer = node.findtext(ns + 'nameOfIssuer')
+        cusip = node.findtext(ns + 'cusip')
+        value = node.findtext(ns + 'value')
+        value = int(value.replace(',', '').replace('-', ''))
+        shares = int(node.find(ns + 'shrsOrPrnAmt').findtext(ns + 'sshPrnamt'))
+        option = node.find(ns + 'putCall')
+        option = str(option.text).upper() if option is not None else ''
+        yield [issuer, cusip, value, shares, option]
+
+        root.clear()
+
 def crawl_xml(filing_url):
     """Crawls XML filing
     INPUT: filing_url to Primary and Information Table
-    OUTPUT: list of holdings as list, and '_diff' variables reflecting differences in reported mkt val and coun
+    OUTPUT: holdings (an iterator of rows, parsed as it's consumed; see
+    iter_info_table), reported market value and count
     """
     
     mv_rep = ct_rep = None
 
-    page = urlfetch.fetch(filing_url).content
+    page = fetch.get(filing_url)
     slug_regexp = r'/Archives/edgar/data/[^/]*/[^/]*'
     slug = re.search(slug_regexp, filing_url).group()
     slugs = re.findall(r'{}{}'.format(slug, r'/[^/"]*.xml'), page)
-    prim_url, info_url = ["http://www.sec.gov{}".format(slug) for slug in slugs]
-
-    # Crawl "Information Table" page for holdings list
-    holdings = []
-
-    r = urlfetch.fetch(info_url).content
-    xml = minidom.parseString(r)
-    rows = xml.getElementsByTagName('infoTable')
-    
-    for row in rows:
-        issuer = row.getElementsByTagName('nameOfIssuer')[0].firstChild.data
-        cusip = row.getElementsByTagName('cusip')[0].firstChild.data
-        value = row.getElementsByTagName('value')[0].firstChild.data
-        value = int(value.replace(',', '').replace('-', ''))
-        shares = row.getElementsByTagName('shrsOrPrnAmt')[0]
-        shares = int(shares.getElementsByTagName('sshPrnamt')[0].firstChild.data)
-        option = row.getElementsByTagName('putCall')
-        option = str(option[0].firstChild.data).upper() if option else ''
-        holdings.append([issuer, cusip, value, shares, option])
+    host = "{0.scheme}://{0.netloc}".format(urlparse.urlparse(filing_url))
+    prim_url, info_url = ["{}{}".format(host, slug) for slug in slugs]
 
     #Crawl primary_doc page for reported mkt value and # position
-    r = urlfetch.fetch(prim_url).content
-    xml = minidom.parseString(r)
-    summary = xml.getElementsByTagName('summaryPage')[0]
-    ct = int(summary.getElementsByTagName('tableEntryTotal')[0].firstChild.data)
-    mv = int(summary.getElementsByTagName('tableValueTotal')[0].firstChild.data)
+    summary = {}
+    for event, node in ET.iterparse(fetch.open_url(prim_url)):
+        summary.setdefault(local_name(node.tag), node.text)
+    ct = int(summary['tableEntryTotal'])
+    mv = int(summary['tableValueTotal'])
+
+    # "Information Table" page, streamed by the caller
+    holdings = iter_info_table(fetch.open_url(info_url))
 
     return holdings, mv, ct
 
@@ -132,7 +166,7 @@ def crawl_filing(filing_url):
     
     holdings = mv_rep = ct_rep = None
     
-    doc_page = urlfetch.fetch(filing_url).content
+    doc_page = fetch.get(filing_url)
     loc = doc_page.find("Period of Report")+50
     as_of = doc_page[loc:loc+10]
     
@@ -145,29 +179,65 @@ def crawl_filing(filing_url):
         holdings, mv_rep, ct_rep = crawl_txt(filing_url)
     else:
         holdings, mv_rep, ct_rep = crawl_xml(filing_url)
+        holdings = list(holdings) # crawl_filing's callers keep the rows
+
+    #Add positions to the cusip => holders index
+    cik = re.search(r'/data/(\d+)/', filing_url)
+    acc = re.search(r'\d{10}-\d{2}-\d{6}', filing_url)
+    holders.add(cik and cik.group(1), as_of, holdings, acc and acc.group())
     
     return holdings, as_of, mv_rep, ct_rep
 
 def get_filings_list(url):
     """Uses URL to filings list to create list of filings with metadata
     INPUT: url to list of filings
-    OUTPUT: manager name, cik and list of filing urls"""
+    OUTPUT: manager name, cik and list of [filing url, date, form type]
+    NOTES: Served from the local catalog if it has filings for the url's CIK
+    and form type, with browse-edgar's filings since the catalog's newest
+    one merged in (those not ingested yet); otherwise the browse-edgar page
+    at url is scraped"""
+
+    params = urlparse.parse_qs(urlparse.urlparse(url).query)
+    cik = params.get('CIK', [''])[0]
+    form = params.get('type', ['13F-HR'])[0].upper()
+    local = catalog.filings(cik, form) if cik.isdigit() else []
+    if not local:
+        return scrape_filings_list(url)
+
+    filings = [[catalog.index_slug(filename), date, form]
+        for date, form, company, filename in local]
+    try:
+        recent = scrape_filings_list(url)[2]
+    except (IOError, AttributeError) as e: # unreachable or unexpected page
+        logging.warning("recent filings not listed for %s: %s", url, e)
+        recent = []
+    known = set(catalog.filename_accession(filename) or filename
+        for date, form, company, filename in local)
+    recent = [filing for filing in recent if filing[1] >= local[0][0]
+        and not known.intersection(ACCESSION_P.findall(filing[0]))]
+
+    return local[0][2], "CIK={:010d}".format(int(cik)), recent + filings
 
-    page = urlfetch.fetch(url).content
+def scrape_filings_list(url):
+    """get_filings_list from the browse-edgar page at url"""
+
+    page = fetch.get(url)
     
     # Get metadata
     manager_pattern = re.compile(r'<span class="companyName">([^<]*)')
     manager = manager_pattern.search(page).groups()[0].strip()
     cik = re.search(r'CIK=\d{10}', page).group()
 
-    # Create table of filing urls and filing dates
-    slugs = re.findall(r'([^"]*)"\s*id="documentsbutton"', page)
-    dates = re.findall(r'<td>(\d{4}-\d{2}-\d{2})</td>', page)
-    
+    # Create table of filing urls, filing dates and form types (e.g.
+    # 13F-HR/A amendments are listed along with the 13F-HR filings)
     filings = []
-    for ix, slug in enumerate(slugs):
-        filing = [slug, dates[ix]]
-        filings.append(filing)
+    for row in re.findall(r'<tr[\s\S]*?</tr>', page):
+        slug = re.search(r'([^"]*)"\s*id="documentsbutton"', row)
+        if slug:
+            date = re.search(r'<td>(\d{4}-\d{2}-\d{2})</td>', row)
+            form = re.search(r'<td nowrap="nowrap">([^<]*)</td>', row)
+            filings.append([slug.group(1), date.group(1),
+                form.group(1) if form else ''])
     
     return manager, cik, filings
 
@@ -191,11 +261,12 @@ def get_manager(manager_raw):
         type='13f-hr', action='getcompany', count=100)
     params = urllib.urlencode(params)
     url = base + params
+
+    # Known to the local catalog => no need to check the search page
+    if cik and catalog.filings(cik, '13F-HR', limit=1):
+        return url
     
-    # for development:
-    #import urllib2
-    #page = urllib2.urlopen(url).read()
-    page = urlfetch.fetch(url).content
+    page = fetch.get(url)
     
     # Return url; if multiple matches, redirect to choose_manager.
     # If no mathes return None
@@ -0,0 +1,142 @@
+from array import array
+import datetime
+
+# CONSTANTS
+DFMT = '%Y-%m-%d'
+ORDINALS, DATES = {}, {} # date string <=> day ordinal memos
+PERIODS = {} # (end, start) ordinals => shared period tuple of date strings
+
+def date_ordinal(date):
+    """ 'YYYY-MM-DD' => proleptic Gregorian day ordinal (memoized) """
+
+    day = ORDINALS.get(date)
+    if day is None:
+        day = datetime.datetime.strptime(date, DFMT).toordinal()
+        ORDINALS[date] = day
+
+    return day
+
+def ordinal_date(day):
+    """ Day ordinal => 'YYYY-MM-DD' (memoized) """
+
+    date = DATES.get(day)
+    if date is None:
+        date = datetime.date.fromordinal(day).strftime(DFMT)
+        DATES[day] = date
+
+    return date
+
+def encode_date(date):
+    """ Day ordinal for date, or None if date doesn't round-trip exactly
+    (e.g. it has a time zone or isn't zero-padded) """
+
+    try:
+        day = date_ordinal(date)
+    except (TypeError, ValueError):
+        return None
+
+    return day if ordinal_date(day) == date else None
+
+class Facts:
+    """Columnar XBRL facts: typed arrays of concept ids, period end and start
+    day ordinals (instants repeat the date), float values and segment ids,
+    with concept names and segments stored once each.
+    Row i is (names[concepts[i]], period(i), values[i],
+    segment_names[segments[i]]); segment id 0 is no segment."""
+
+    def __init__(self):
+        self.names, self.name_ids = [], {}
+        self.segment_names, self.segment_ids = [''], {'': 0}
+        self.concepts = array('i')
+        self.ends = array('i')
+        self.starts = array('i')
+        self.values = array('d')
+        self.segments = array('i')
+        self.irregular = {} # row => period that isn't two encodable dates
+        self.by_concept = {} # concept id => array('i') of rows (see index)
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """INPUT: iterable of (name, period, value, segment) as yielded by
+        Filing.stream_instances"""
+
+        facts = cls()
+        for name, period, value, segment in rows:
+            facts.append(name, period, value, segment)
+
+        return facts
+
+    def append(self, name, period, value, segment):
+        concept = self.name_ids.get(name)
+        if concept is None:
+            concept = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        seg = self.segment_ids.get(segment)
+        if seg is None:
+            seg = self.segment_ids[segment] = len(self.segment_names)
+            self.segment_names.append(segment)
+
+        end = start = None
+        if len(period) == 2:
+            end, start = encode_date(period[0]), encode_date(period[1])
+        if end is None or start is None:
+            self.irregular[len(self)] = period
+            end = start = 0
+
+        self.concepts.append(concept)
+        self.ends.append(end)
+        self.starts.append(start)
+        self.values.append(value)
+        self.segments.append(seg)
+
+    def period(self, ix):
+        """(end, start) date strings of row ix; equal periods share a tuple"""
+
+        if ix in self.irregular:
+            return self.irregular[ix]
+        key = (self.ends[ix], self.starts[ix])
+        period = PERIODS.get(key)
+        if period is None:
+            period = PERIODS[key] = (ordinal_date(key[0]), ordinal_date(key[1]))
+
+        return period
+
+    def row(self, ix):
+        return (self.names[self.concepts[ix]], self.period(ix), self.values[ix],
+            self.segment_names[self.segments[ix]])
+
+    def rows(self):
+        return [self.row(ix) for ix in xrange(len(self))]
+
+    def index(self):
+        """Indexes rows by concept, in document order"""
+
+        self.by_concept = {}
+        for ix, concept in enumerate(self.concepts):
+            rows = self.by_concept.get(concept)
+            if rows is None:
+                rows = self.by_concept[concept] = array('i')
+            rows.append(ix)
+
+    def matches(self, name, non_core=False):
+        """(period, value) tuples for facts named exactly name, in document
+        order, including segmented facts only if non_core"""
+
+        concept = self.name_ids.get(name)
+        if concept is None:
+            return []
+
+        return [(self.period(ix), self.values[ix])
+            for ix in self.by_concept.get(concept, ())
+            if non_core or not self.segments[ix]]
+
+    def nbytes(self):
+        """Bytes held by the typed columns and row index"""
+
+        columns = [self.concepts, self.ends, self.starts, self.values,
+            self.segments] + self.by_concept.values()
+
+        return sum(len(column) * column.itemsize for column in columns)
@@ -0,0 +1,521 @@
+import hashlib
+import logging
+import os
+import re
+import StringIO
+import threading
+import time
+import urlparse
+import zlib
+
+from collections import OrderedDict
+from Queue import Empty, Queue
+
+try:
+    from google.appengine.api import urlfetch
+    production = True
+
+except ImportError:
+    import urllib2
+    production = False
+
+
+# CONSTANTS
+WORKERS = 8 # default concurrent fetch threads for pmap
+SEC_RATE = 10 # max requests per second per host (SEC fair access policy)
+CACHE_DIR = os.environ.get('OPENSEC_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+CACHE_BYTES = 512 * 2**20 # compressed size before LRU eviction
+SEARCH_TTL = 15 * 60 # seconds to keep mutable pages (e.g. browse-edgar)
+# documents of an accepted filing never change: those in its accession
+# folder (not its index pages) and its full submission .txt
+IMMUTABLE_P = re.compile(r'/Archives/edgar/data/\d+/'
+    r'(?:\d{18}/[^/]+|\d{10}-\d{2}-\d{6}\.txt)\Z')
+INDEX_PAGE_P = re.compile(r'(?:/|-)index(?:-headers)?\.(?:json|xml|html?)\Z')
+MAX_EXPIRY = 30 * 24 * 3600 # memcache reads longer times as Unix timestamps
+
+class RateLimiter:
+    """ Spaces out requests to each host (or to all hosts together, if not
+    per_host) to at most 'rate' per second.
+    Thread-safe; callers block in wait() until their slot comes up. """
+
+    def __init__(self, rate, per_host=True):
+
+        self.interval = 1. / rate
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+
+        host = urlparse.urlparse(url).netloc if self.per_host else None
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0))
+            self.next_slot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+class Inflater:
+    """ Read-only file-like object decompressing the zlib stream in file f
+    a chunk at a time, so a cached document can be parsed incrementally """
+
+    def __init__(self, f, chunk=2**16):
+
+        self.f = f
+        self.chunk = chunk
+        self.decompressor = zlib.decompressobj()
+        self.buffer = ''
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.buffer) < size:
+            data = self.f.read(self.chunk)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def close(self):
+
+        self.f.close()
+
+class DiskCache:
+    """ On-disk cache of url contents, zlib compressed, one file per url
+    named by the url's sha1. Each file starts with the fetch time so
+    entries can expire; file mtimes are bumped on reads and the least
+    recently used files are evicted once max_bytes is exceeded.
+    If directory can't be created (e.g. read-only filesystem), the cache
+    is disabled and every lookup misses. """
+
+    def __init__(self, directory, max_bytes):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.size = 0
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for path in self._paths():
+                self.size += os.path.getsize(path)
+        except (IOError, OSError) as e:
+            logging.warning("disk cache disabled: %s", e)
+            self.enabled = False
+
+    def _paths(self):
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.tmp'):
+                    yield os.path.join(dirpath, filename)
+
+    def _path(self, url):
+
+        digest = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, url, ttl=None):
+        """ Returns cached contents of url, or None if missing or older
+        than ttl seconds (ttl None never expires). """
+
+        if not self.enabled:
+            return None
+
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as f:
+                fetched, data = f.read().split('\n', 1)
+            if ttl is not None and time.time() - float(fetched) > ttl:
+                return None
+            os.utime(path, None)
+            return zlib.decompress(data)
+        except (IOError, OSError, ValueError, zlib.error):
+            return None
+
+    def open(self, url, ttl=None):
+        """ Like get, but returns an Inflater over the cached file instead of
+        its whole contents """
+
+        if not self.enabled:
+            return None
+
+        path = self._path(url)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            fetched = float(f.readline())
+            if ttl is not None and time.time() - fetched > ttl:
+                f.close()
+                return None
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            f.close()
+            return None
+
+        return Inflater(f)
+
+    def set(self, url, content):
+
+        if not self.enabled:
+            return
+
+        path = self._path(url)
+        data = "{:.0f}\n{}".format(time.time(), zlib.compress(content))
+        tmp = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logging.warning("disk cache write failed for %s: %s", url, e)
+            return
+
+        with self.lock:
+            self.size += len(data) - old
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Removes least recently used files until under 90% of max_bytes.
+        Call with self.lock held. """
+
+        entries = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self.size = sum(el[1] for el in entries)
+        for mtime, size, path in sorted(entries):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                continue
+
+class LRUCache:
+    """ Thread-safe in-process mapping holding at most 'size' entries,
+    dropping the least recently used. """
+
+    def __init__(self, size):
+
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_multi(self, keys):
+        """ Returns dict of key => value for the keys present """
+
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    found[key] = self.entries.pop(key)
+                    self.entries[key] = found[key]
+
+        return found
+
+    def set_multi(self, mapping):
+
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries.pop(key, None)
+                self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+
+        return self.get_multi([key]).get(key, default)
+
+    def set(self, key, value, time=0):
+        """ time is accepted for memcache compatibility; entries only leave
+        by LRU eviction """
+
+        self.set_multi({key: value})
+
+    def add(self, key, value, time=0):
+        """ Sets key only if absent, like memcache.add. OUTPUT: True if set """
+
+        with self.lock:
+            if key in self.entries:
+                return False
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return True
+
+    def delete(self, key):
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+class Flight:
+    """ One in-progress build of a StaleCache key, for callers to wait on """
+
+    def __init__(self):
+
+        self.done = threading.Event()
+        self.value = self.error = None
+
+class StaleCache:
+    """ Stale-while-revalidate cache of values built by a function.
+    Entries are fresh for ttl seconds and then served stale for up to
+    stale_ttl more while one background refresh rebuilds them. Concurrent
+    misses for a key share one build (singleflight), and exceptions of the
+    types in errors are cached for negative_ttl seconds (with no stale
+    window: the next get after that rebuilds) and re-raised.
+    Backend expiry times are capped at MAX_EXPIRY.
+    backend needs memcache-style get(key), set(key, value, time) and
+    optionally add and delete, used for a lease (held for at most 'lease'
+    seconds) so only one process refreshes a key; LRUCache or the memcache
+    module both work. spawn(key, build) has revalidate(key, build) run off
+    the request; the default runs it on a daemon thread, which suits local
+    and in-process use only (App Engine joins request threads before it
+    responds, so pass one that queues a task there). """
+
+    def __init__(self, backend, ttl, stale_ttl, negative_ttl=60, errors=(),
+            spawn=None, prefix='', lease=600):
+
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        if ttl + stale_ttl > MAX_EXPIRY:
+            logging.warning("cache entries kept %d days at most, not %d",
+                MAX_EXPIRY // 86400, (ttl + stale_ttl) // 86400)
+        self.negative_ttl = negative_ttl
+        self.errors = tuple(errors)
+        self.spawn = spawn or self._thread
+        self.prefix = prefix
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def _thread(self, key, build):
+
+        thread = threading.Thread(target=self.revalidate, args=(key, build))
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key, build):
+        """ Returns value for key, calling build() to make it on a miss and
+        having spawn rebuild it once it's stale """
+
+        entry = self.entry(key)
+        if entry is None:
+            return self.refresh(key, build)
+
+        value, fresh_until, error = entry
+        if time.time() >= fresh_until:
+            if error is not None: # negative entries aren't served stale
+                return self.refresh(key, build)
+            self._spawn(key, build)
+        if error is not None:
+            raise error
+
+        return value
+
+    def entry(self, key):
+        """ Returns stored (value, fresh_until, error) for key, or None """
+
+        entry = self.backend.get(self.prefix + key)
+
+        return entry if isinstance(entry, tuple) and len(entry) == 3 else None
+
+    def refresh(self, key, build):
+        """ Rebuilds key now in this thread (joining a build in progress)
+        and returns the new value, e.g. to warm it ahead of expiry """
+
+        key = self.prefix + key
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if leader:
+            self._build(key, build, flight)
+
+        return self._wait(flight)
+
+    def revalidate(self, key, build):
+        """ Rebuilds stale key for spawn and releases its lease.
+        OUTPUT: the new value, or None if the build failed (see _build) """
+
+        try:
+            return self.refresh(key, build)
+        except Exception:
+            return None
+        finally:
+            delete = getattr(self.backend, 'delete', None)
+            if delete is not None:
+                delete(self.prefix + key + '|lease')
+
+    def _spawn(self, key, build):
+        """ Has spawn rebuild stale key unless it's being built here or
+        another process holds its lease """
+
+        with self.lock:
+            if self.prefix + key in self.flights:
+                return
+        lease = self.prefix + key + '|lease'
+        add = getattr(self.backend, 'add', None)
+        if add is not None and not add(lease, 1, time=self.lease):
+            return
+
+        try:
+            self.spawn(key, build)
+        except Exception as e: # e.g. task queue unavailable; serve stale
+            logging.warning("refresh of %s not started: %r", key, e)
+            if hasattr(self.backend, 'delete'):
+                self.backend.delete(lease)
+
+    def _build(self, key, build, flight):
+
+        try:
+            flight.value = build()
+            self._store(key, flight.value, None, self.ttl, self.stale_ttl)
+        except self.errors as e:
+            flight.error = e
+            self._store(key, None, e, self.negative_ttl, 0)
+        except BaseException as e: # e.g. DeadlineExceededError; not cached
+            flight.error = e
+            logging.warning("cache build failed for %s: %r", key, e)
+        finally:
+            self._land(key, flight)
+
+    def _land(self, key, flight):
+
+        with self.lock:
+            self.flights.pop(key, None)
+        flight.done.set()
+
+    def _store(self, key, value, error, ttl, stale_ttl):
+
+        entry = (value, time.time() + ttl, error)
+        try:
+            self.backend.set(key, entry,
+                time=max(int(min(ttl + stale_ttl, MAX_EXPIRY)), 1)) # 0: never
+        except ValueError as e: # e.g. too large for memcache
+            logging.warning("not cached %s: %s", key, e)
+
+    def _wait(self, flight):
+
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+
+        return flight.value
+
+limiter = RateLimiter(SEC_RATE)
+cache = DiskCache(CACHE_DIR, CACHE_BYTES)
+
+def ttl_for(url):
+    """ Returns cache lifetime for url: None (forever) for filed documents,
+    SEARCH_TTL for everything else (search and browse pages, directory
+    listings, filing index pages and full-index files). """
+
+    path = urlparse.urlparse(url).path
+    if IMMUTABLE_P.match(path) and not INDEX_PAGE_P.search(path):
+        return None
+
+    return SEARCH_TTL
+
+def get(url):
+    """ Returns contents of url from the disk cache, else fetches it subject
+    to the host rate limit and caches it. Raises IOError for responses
+    other than 200 (e.g. SEC rate-limit and error pages), which aren't
+    cached. """
+
+    ttl = ttl_for(url)
+    content = cache.get(url, ttl)
+    if content is not None:
+        return content
+
+    limiter.wait(url)
+    if production:
+        response = urlfetch.fetch(url)
+        status, content = response.status_code, response.content
+    else:
+        try:
+            response = urllib2.urlopen(url)
+            status, content = response.getcode(), response.read()
+        except urllib2.HTTPError as e:
+            status = e.code
+
+    if status not in (200, None): # None: not HTTP, e.g. a file: url
+        raise IOError("HTTP {} fetching {}".format(status, url))
+
+    cache.set(url, content)
+
+    return content
+
+def open_url(url):
+    """ Returns a file-like object for the contents of url (see get),
+    decompressed from the disk cache as it's read if the url is cached
+    there (after fetching it, on a miss), else held in memory """
+
+    ttl = ttl_for(url)
+    stream = cache.open(url, ttl)
+    if stream is None:
+        content = get(url)
+        stream = cache.open(url, ttl)
+        if stream is None: # cache disabled or not writable
+            return StringIO.StringIO(content)
+
+    return stream
+
+def pmap(func, items, workers=WORKERS):
+    """ Like map(func, items), run on up to 'workers' threads.
+    Results keep the order of items; the first exception (in item order)
+    is re-raised in the calling thread. """
+
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    queue = Queue()
+    for ix, item in enumerate(items):
+        queue.put((ix, item))
+
+    def worker():
+        while True:
+            try:
+                ix, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[ix] = func(item)
+            except Exception as e:
+                errors[ix] = e
+
+    threads = [threading.Thread(target=worker)
+        for i in xrange(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    return results
@@ -4,26 +4,23 @@ import json
 import logging
 import os
 import re
-import time
 import urllib
 
+from operator import itemgetter
 from xml.dom import minidom
 import xml.etree.ElementTree as ET
 
-try:
-    from google.appengine.api import urlfetch
-    production = True
-
-except ImportError:
-    import urllib2
-    production = False
-
+import catalog
+import facts
+import fetch
 
 # CONSTANTS
 ROOT = "http://www.sec.gov/"
 SEARCH_PATH = "cgi-bin/browse-edgar/?"
 DATA_PATH = "Archives/edgar/data/"
 DFMT = '%Y-%m-%d'
+XBRL_START = '2009-06-15' # earliest filings with XBRL instance documents
+DUPLICATE = object() # marks a name with 2+ rows at one key in align()
 
 # simplified version of http://effbot.org/zone/re-sub.htm#unescape-html
 def unescape(text):
@@ -47,9 +44,110 @@ def decr_date(date):
 
     return dt
 
+def accession(url):
+    """ Returns accession number (e.g. 0001193125-13-416534) from a filing
+    url, or the url itself if it doesn't contain one. """
+
+    match = re.search(r'\d{10}-\d{2}-\d{6}', url)
+    if match:
+        return match.group()
+
+    match = re.search(r'{}\d+/(\d{{10}})(\d{{2}})(\d{{6}})/'.format(DATA_PATH), url)
+    if match:
+        return '-'.join(match.groups())
+
+    return url
+
+def latest_filing(cik):
+    """ Date of the newest 10-/20- filing with interactive (XBRL) data that
+    browse-edgar lists for cik, or None. One fetch of the 40 newest filings
+    of all forms, cached for fetch.SEARCH_TTL. """
+
+    params = urllib.urlencode(dict(action="getcompany", CIK=cik, count=40))
+    source = fetch.get("{}{}{}".format(ROOT, SEARCH_PATH, params))
+
+    for row in re.findall(r'<tr[\s\S]*?</tr>', source):
+        form = re.search(r'<td nowrap="nowrap">([^<]*)</td>', row)
+        date = re.search(r'<td>(\d{4}-\d{2}-\d{2})</td>', row)
+        if (form and date and row.find('interactiveDataBtn') <> -1
+                and form.group(1).startswith(('10-', '20-'))):
+            return date.group(1)
+
+    return None
+
+def parse_context(context):
+    """ Returns (period, segment) for an xbrli:context element.
+    Period is an (end_date, start_date) tuple; instants repeat the date.
+    Segment is the text of the last explicitMember, or empty string.
+    """
+
+    period, segment = [], ''
+
+    for el in context.iter():
+
+        if el.tag.endswith("explicitMember"):
+            segment = el.text
+        if el.tag.endswith("instant"):
+            period = [el.text.strip(), el.text.strip()]
+        if el.tag.endswith("startDate"):
+            period.append(el.text.strip())
+        if el.tag.endswith("endDate"):
+            period.insert(0, el.text.strip())
+
+    return tuple(period), segment
+
+def align(fields, key=itemgetter(0)):
+    """ Joins fields on key in one pass over all their rows.
+    INPUT: dict of name => list of rows (e.g. (period, value) tuples)
+    OUTPUT: dict of key => {name: row}. A name with more than one row at
+    a key is left out of that key's dict, since it can't be paired.
+    """
+
+    table = {}
+    for name, rows in fields.items():
+        for row in rows:
+            named = table.setdefault(key(row), {})
+            named[name] = DUPLICATE if name in named else row
+
+    for named in table.itervalues():
+        for name in [name for name, row in named.items() if row is DUPLICATE]:
+            del named[name]
+
+    return table
+
+def derive(table, specs, value=itemgetter(-1), label=itemgetter(0)):
+    """ Evaluates derived fields over an aligned table (see align) in one
+    pass over its keys.
+    INPUT: specs, list of (name, func, name1, name2); func is applied to
+    the values of name1's and name2's rows at each key having both
+    OUTPUT: dict of name => list of (label(name1's row), func(...)) tuples;
+    None results (e.g. from divide by zero) are left out
+    """
+
+    derived = dict((spec[0], []) for spec in specs)
+    for named in table.itervalues():
+        for name, func, name1, name2 in specs:
+            if name1 in named and name2 in named:
+                result = func(value(named[name1]), value(named[name2]))
+                if result is not None:
+                    derived[name].append((label(named[name1]), result))
+
+    return derived
+
+def add(x, y):
+    return x + y
+
+def subtract(x, y):
+    return x - y
+
+def divide(numer, denom):
+    """ numer / denom, or None if denom is zero """
+
+    return numer / denom if denom else None
+
 class Filing:
 
-    def __init__(self, url):
+    def __init__(self, url, stream=False):
         
         self.ACCOUNTING_FIELDS = [
             ('SharesOutstanding', (
@@ -109,21 +207,19 @@ class Filing:
             ('LongTermInvestments', ('LongTermInvestments'), None, False)
         ]
 
-        start = time.time()
-        print "parsing filing...",
-        self._load_root(url)
-        print "{} seconds".format(time.time() - start)
         self.fields = {}
-        self.get_instances()
+        if stream:
+            self.instances = facts.Facts.from_rows(
+                self.stream_instances(fetch.open_url(url)))
+        else:
+            self._load_root(url)
+            self.get_instances()
+        self.index_instances()
         self.get_fields()
 
-
     def _load_root(self, url):
 
-        if production:
-            data = urlfetch.fetch(url).content
-        else:
-            data = urllib2.urlopen(url).read()
+        data = fetch.get(url)
 
         root = ET.fromstring(data)
 
@@ -171,25 +267,20 @@ class Filing:
         """
 
         if not func:
-            func = lambda x, y: x + sign * y
+            func = add if sign == 1 else subtract
 
-        periods = list(set(map(lambda x: x[0], field1 + field2)))
-        output = []
-        for period in periods:
-            first = filter(lambda x: x[0] == period, field1)
-            if len(first) == 1:
-                second = filter(lambda x: x[0] == period, field2)
-                if len(second) == 1:
-                    output.append((period, func(first[0][-1], second[0][-1])))
+        table = align({1: field1, 2: field2})
 
-        return output
+        return derive(table, [(0, func, 1, 2)])[0]
 
     def get_instances(self):
 
-        """ Returns list of ('name', 'period', 'value', 'segment') tuples. """
+        """ Collects ('name', 'period', 'value', 'segment') facts into
+        self.instances, a facts.Facts table. """
+
+        self.instances = facts.Facts()
+        self.get_contexts()
 
-        self.instances = []
-        
         for node in self.root.iter():
             # asof from DocumentPeriodEndDate (no unitRef attr):
             if node.tag.endswith('DocumentPeriodEndDate'):
@@ -202,52 +293,118 @@ class Filing:
                 # Get name and value from tag name and inner text contents
                 name = node.tag.split('}')[-1]
                 value = float(node.text)
-                # Initialize period to empty list and segment to empty string
-                period, segment = [], ''
-                
-                # Get period and segment (if any) from context
-                context = self.root.find("*[@id='{}']".format(node.attrib['contextRef']))
-                
-                for el in context.iter():
-                
-                    if el.tag.endswith("explicitMember"):
-                        segment = el.text
-                    if el.tag.endswith("instant"):
-                        period = [el.text.strip(), el.text.strip()]
-                    if el.tag.endswith("startDate"):
-                        period.append(el.text.strip())
-                    if el.tag.endswith("endDate"):
-                        period.insert(0, el.text.strip())
-
-                period = tuple(period)
-
-                self.instances.append((name, period, value, segment))
 
-    def name_matches(self, query, non_core=False):
- 
-        regexp = "^{}$".format(query)
-        p = re.compile(regexp)
+                # Get period and segment (if any) from context index
+                period, segment = self.contexts[node.attrib['contextRef']]
+
+                self.instances.append(name, period, value, segment)
+
+    def stream_instances(self, source):
+        """ Yields ('name', 'period', 'value', 'segment') tuples from file-like
+        source with iterparse, clearing each top-level element once handled
+        so memory stays bounded regardless of document size.
+        NOTES: Facts whose context has been seen are yielded at once, in
+        document order (as get_instances, when contexts come first, as
+        filers put them). Facts whose context has not been seen yet are
+        held back by contextRef and yielded when it closes; facts
+        referencing a context that never appears are dropped.
+        """
+
+        contexts = {}
+        pending = {} # contextRef => [(name, value)] awaiting that context
+        depth = 0
+        root = None
+
+        for event, node in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = node
+                depth += 1
+                continue
 
-        matches = filter(lambda x: p.match(str(x[0])), self.instances)
-        if not non_core:
-            matches = filter(lambda x: not x[-1], matches)
+            depth -= 1
 
-        results = [el[1:3] for el in matches]
+            # contexts are children of the root (see get_contexts)
+            if depth == 1 and node.tag.endswith('}context'):
+                ref = node.attrib['id']
+                period, segment = contexts[ref] = parse_context(node)
+                for name, value in pending.pop(ref, ()):
+                    yield (name, period, value, segment)
 
-        return results
+            elif node.tag.endswith('DocumentPeriodEndDate'):
+                self.fields['asof'] = node.text
+
+            elif node.attrib.has_key('unitRef') and node.text:
+                name = node.tag.split('}')[-1]
+                value = float(node.text)
+                ref = node.attrib['contextRef']
+                if ref in contexts:
+                    period, segment = contexts[ref]
+                    yield (name, period, value, segment)
+                else:
+                    pending.setdefault(ref, []).append((name, value))
+
+            if depth == 1:
+                root.clear()
+
+        for ref, held in pending.items():
+            for name, value in held:
+                logging.warning("context %s not found for %s", ref, name)
+
+    def get_contexts(self):
+        """ Indexes contexts by id in one pass over the root's children.
+        OUTPUT: self.contexts, dict of id => (period, segment) tuples
+        """
+
+        self.contexts = {}
+
+        for node in self.root:
+            if node.tag.endswith('}context'):
+                self.contexts[node.attrib['id']] = parse_context(node)
+
+    def index_instances(self):
+        """ Indexes instances by concept, in document order """
+
+        self.instances.index()
+
+    def name_matches(self, query, non_core=False):
+        """ Returns (period, value) tuples for facts named exactly query,
+        including segmented facts only if non_core. """
+
+        return self.instances.matches(query, non_core)
 
     def accounting_adj(self):
         """Clean ups to accounting fields after all other attempts finished"""
         # If wav shares above didn't work, impute NIL and EPS
         self.fields['WeightedAverageDilutedShares'] = self.impute(
             1, self.fields['NetIncomeLoss'], self.fields['EarningsPerShare'],
-            func=self.divide)
+            func=divide)
 
 class Company:
 
-    def __init__(self, ticker):
-
-        self.filings_list = []
+    # derived quarterly fields for hist_derived: (name, func, field1, field2)
+    DERIVED = [
+        ('NetMargin', divide, 'NetIncomeLoss', 'Revenues'),
+        ('RevenuePerShare', divide, 'Revenues', 'WeightedAverageDilutedShares'),
+        ('NetIncomePerShare', divide, 'NetIncomeLoss',
+            'WeightedAverageDilutedShares'),
+    ]
+
+    # company table rows: (metrics key, concept or DERIVED name, metrics
+    # key for yearly totals or None, formatter method name)
+    METRICS = [
+        ('revenues', 'Revenues', 'revenue_totals', 'fmt_val'),
+        ('eps', 'EarningsPerShare', 'eps_totals', 'fmt_per_sh'),
+    ]
+
+    def __init__(self, ticker, workers=fetch.WORKERS, store=None):
+        """ store, if given, persists parsed filings across instances; it
+        needs memcache-style get_multi(keys) and set_multi(mapping) and is
+        keyed by accession number, so only new filings are fetched. """
+
+        self.workers = workers
+        self.store = store
+        self.filings_list = [] # (filing date, filing index url) tuples
         self.meta = dict(ticker=ticker.upper(), filing_dates=[])
         self.filings = dict() # all fields found by AccountingFields
         self.get_filings()
@@ -257,14 +414,87 @@ class Company:
         if not self.filings_list:
             self.get_filings_list()
 
-        for fdate, furl in self.filings_list:
-            key = "{}|{}".format(fdate, furl)
-            filing = Filing(furl)
-            self.filings[key] = filing.fields
-            self.meta['filing_dates'].append((filing.fields['asof'], fdate))
+        accessions = [accession(url) for fdate, url in self.filings_list]
+        stored = {}
+        if self.store is not None:
+            stored.update(self.store.get_multi(accessions))
+
+        # fetch and parse new filings concurrently, keeping list order
+        new = [(acc, item) for acc, item in zip(accessions, self.filings_list)
+            if acc not in stored]
+        parsed = fetch.pmap(lambda (acc, item): self.parse_filing(*item), new,
+            self.workers)
+        parsed = dict(zip([acc for acc, item in new], parsed))
+        if self.store is not None and parsed:
+            self.store.set_multi(parsed)
+        stored.update(parsed)
+        self.new_filings = len(parsed)
+
+        for acc in accessions:
+            filing = stored[acc]
+            if filing['fields'] is None:
+                continue
+            key = "{}|{}".format(filing['date'], filing['url'])
+            self.filings[key] = filing['fields']
+            self.meta['filing_dates'].append(
+                (filing['fields']['asof'], filing['date']))
+
+    def parse_filing(self, fdate, index_url):
+        """ Parses the XBRL instance linked from a filing index page.
+        OUTPUT: dict of filing date, instance url and Filing fields """
+
+        xml_p = re.compile(r'{}.*?\d{{8}}\.xml'.format(DATA_PATH))
+
+        xml_slugs = xml_p.findall(fetch.get(index_url))
+        if not xml_slugs: # no XBRL; only possible for catalog listings
+            return dict(date=fdate, url=index_url, fields=None)
+        f_url = "{}{}".format(ROOT, xml_slugs[0])
+        filing = Filing(f_url, stream=True)
+
+        return dict(date=fdate, url=f_url, fields=filing.fields)
 
     def get_filings_list(self):
+        """Lists 10-/20- filings from the local catalog if it knows the
+        ticker's CIK, with browse-edgar's filings since the catalog's newest
+        one merged in (those not ingested yet); else from browse-edgar (then
+        records ticker's CIK)"""
 
+        cik = catalog.ticker_cik(self.meta['ticker'])
+        local = []
+        for form in ['10-', '20-']:
+            local += catalog.filings(cik, form, since=XBRL_START) if cik else []
+        if not local:
+            self.filings_list = self.browse_filings_list()
+            catalog.set_ticker(self.meta['ticker'], self.meta['cik'])
+            return
+
+        try:
+            recent = self.browse_filings_list()
+        except (IOError, IndexError) as e: # unreachable or unexpected page
+            logging.warning("recent filings not listed for %s: %s",
+                self.meta['ticker'], e)
+            recent = []
+        self.meta['name'] = local[0][2].upper()
+        self.meta['cik'] = "{:010d}".format(cik)
+        newest = max(date for date, form, company, filename in local)
+        known = set(catalog.filename_accession(filename)
+            for date, form, company, filename in local)
+        self.filings_list = []
+        for date, url in recent:
+            if date >= newest and accession(url) not in known:
+                known.add(accession(url))
+                self.filings_list.append((date, url))
+        self.filings_list += [(date, "{}{}".format(ROOT[:-1],
+            catalog.index_slug(filename)))
+            for date, form, company, filename in local]
+
+    def browse_filings_list(self):
+        """Scrapes browse-edgar for the ticker's 10-/20- filings with XBRL
+        data (setting meta name and cik)
+        OUTPUT: list of (filing date, filing index url), newest first per
+        form type"""
+
+        filings_list = []
         params = dict(action="getcompany", count=100)
         params['ticker']= self.meta['ticker']
 
@@ -273,17 +503,13 @@ class Company:
         row_p = re.compile(r'<tr[\s\S]*?</tr>')
         slug_p = re.compile(r'href="(\S*index.html?)"')
         date_p = re.compile(r'<td>(\d{4}-\d{2}-\d{2})</td>')
-        xml_p = re.compile(r'{}.*?\d{{8}}\.xml'.format(DATA_PATH))
         
         for form in ['10-', '20-']:
             params['type'] = form
             enc_params = urllib.urlencode(params)
             url = "{}{}{}".format(ROOT, SEARCH_PATH, enc_params)
             
-            if production:
-                source = urlfetch.fetch(url).content
-            else:
-                source = urllib2.urlopen(url).read()
+            source = fetch.get(url)
 
             name = name_p.findall(source)[0]
             self.meta['name'] = unescape(name).upper()
@@ -294,31 +520,31 @@ class Company:
             
             urls = map(lambda x: "{}{}".format(ROOT[:-1], slug_p.findall(x)[0]), rows)
             dates = map(lambda x: date_p.findall(x)[0], rows)
-                
-            for ix, url in enumerate(urls):
 
-                f_date = dates[ix]
-
-                if production:
-                    f_source = urlfetch.fetch(url).content
-                else:
-                    f_source = urllib2.urlopen(url).read()
+            filings_list += zip(dates, urls)
 
-                xml_slug = xml_p.findall(f_source)[0]
-                f_url = "{}{}".format(ROOT, xml_slug)
-                self.filings_list.append((f_date, f_url))
+        return filings_list
 
-    def get_metrics(self):
-        """ Add metrics for html presentation """ 
+    def get_metrics(self, metrics=None):
+        """ Add metrics for html presentation
+        INPUT: metrics, list of rows like METRICS (default). The first
+        row's concept must be a filed one (not DERIVED); its quarters set
+        the table's years, months and filing dates.
+        NOTES: Each concept's quarters are loaded once (DERIVED ones in one
+        hist_derived pass) and all grids are filled from a single bucketing
+        of their quarters by (year, month) (see to_arrays).
+        """
 
         self.metrics = dict() # fields prepared for html templates
-        revenues = sorted(self.hist_quarters('Revenues'), reverse=True)
-        eps = sorted(self.hist_quarters('EarningsPerShare'), reverse=True)
-        
-        dts = [decr_date(rev[0][0]) for rev in revenues]
-        filing_dates = [(decr_date(el[0][0]), el[2]) for el in revenues]
-        revenues = [(decr_date(el[0][0]), el[1]) for el in revenues]
-        eps = [(decr_date(el[0][0]), el[1]) for el in eps]
+        metrics = metrics or self.METRICS
+        concepts = set(row[1] for row in metrics)
+        derived = [spec for spec in self.DERIVED if spec[0] in concepts]
+        hist = self.hist_derived(derived) if derived else {}
+        for concept in concepts - set(hist):
+            hist[concept] = sorted(self.hist_quarters(concept), reverse=True)
+
+        first = hist[metrics[0][1]]
+        dts = [decr_date(el[0][0]) for el in first]
         
         self.metrics['years'] = sorted(list(set([dt.year for dt in dts])),
             reverse=True)[:5]
@@ -326,34 +552,52 @@ class Company:
             dt.strftime('%b').upper()) for dt in dts])))
         self.metrics['numcols'] = len(self.metrics['years'])
 
-        # loop the below?
-        self.to_array('revenues', revenues)
-        self.metrics['revenue_totals'] = map(lambda l: sum(filter(None, l)), self.metrics['revenues'])
-        self.to_array('eps', eps)
-        self.metrics['eps_totals'] = map(lambda l: sum(filter(None, l)), self.metrics['eps'])
+        series = dict((key, [(decr_date(el[0][0]), el[1]) for el in hist[concept]])
+            for key, concept, totals, fmt in metrics)
+        series['filedates'] = [(dt, el[2]) for dt, el in zip(dts, first)]
+        self.to_arrays(series)
 
-        self.to_array('filedates', filing_dates)
-        
-        self.metrics['unit'] = self.get_unit()
-        self.metrics['revenue_totals'] = map(self.fmt_val, self.metrics['revenue_totals'])
-        self.metrics['revenues'] = [map(self.fmt_val, items) for items in self.metrics['revenues']]
+        for key, concept, totals, fmt in metrics:
+            if totals:
+                self.metrics[totals] = map(lambda l: sum(filter(None, l)),
+                    self.metrics[key])
+
+        self.metrics['unit'] = self.get_unit(metrics)
+        for key, concept, totals, fmt in metrics:
+            fmt = getattr(self, fmt)
+            if totals:
+                self.metrics[totals] = map(fmt, self.metrics[totals])
+            self.metrics[key] = [map(fmt, items) for items in self.metrics[key]]
 
         shs = sorted(self.filings.items(), reverse=True)[0][1]['SharesOutstanding']
         shs = sorted(shs, reverse=True)[0][1]
         self.metrics['shs'] = self.fmt_val(shs)
-        self.metrics['eps_totals'] = map(self.fmt_per_sh, self.metrics['eps_totals'])
-        self.metrics['eps'] = [map(self.fmt_per_sh, items) for items in self.metrics['eps']]
 
-    def to_array(self, key, fields):
+    def to_arrays(self, series):
+        """ Fills a years x months grid in self.metrics for each key of
+        series, a dict of key => list of (datetime, value). A cell holds
+        the value if exactly one falls in its month, else None.
+        NOTES: all series are bucketed by (year, month) in one pass, so
+        cost doesn't grow with the number of cells per series. """
+
+        cells = {}
+        for key, fields in series.items():
+            for dt, value in fields:
+                cells.setdefault((dt.year, dt.month), {}).setdefault(key,
+                    []).append(value)
+
+        for key in series:
+            self.metrics[key] = []
+            for yr in self.metrics['years']:
+                year = []
+                for mo in self.metrics['months']:
+                    values = cells.get((yr, mo[0]), {}).get(key, ())
+                    year.append(values[0] if len(values) == 1 else None)
+                self.metrics[key].append(year)
 
-        self.metrics[key] = []
+    def to_array(self, key, fields):
 
-        for yr in self.metrics['years']:
-            year = []
-            for mo in self.metrics['months']:
-                val = filter(lambda x: x[0].year == yr and x[0].month == mo[0], fields)
-                year.append(val[0][1] if len(val) == 1 else None)
-            self.metrics[key].append(year)
+        self.to_arrays({key: fields})
 
     def fmt_val(self, value):
 
@@ -365,13 +609,26 @@ class Company:
 
         return value and "{:.2f}".format(float(value))
 
-    def get_unit(self):
+    def fmt_pct(self, value):
+
+        return value and "{:.1f}%".format(100. * value)
+
+    def get_unit(self, metrics=None):
+        """ Returns (unit, label) scaling the largest value shown with
+        fmt_val among metrics (rows like METRICS; their yearly totals, or
+        their cells if they have none). Thousands if there are none. """
 
         unit_labels = {1000: 'thousands', 1000000: 'millions',
             1000000000: 'billions'}
+        values = []
+        for key, concept, totals, fmt in metrics or self.METRICS:
+            if fmt == 'fmt_val':
+                values += (self.metrics[totals] if totals else
+                    [value for year in self.metrics[key] for value in year])
         unit = 1000
-        top = max(self.metrics['revenue_totals']) / unit
-        while top > 1999999: # Values greater than '1,999,999.0' ==> '2,000.0'
+        top = max([abs(value) for value in values if value] or [0]) / unit
+        # Values greater than '1,999,999.0' ==> '2,000.0'
+        while top > 1999999 and unit < max(unit_labels):
             top /= 1000
             unit *= 1000
 
@@ -380,15 +637,26 @@ class Company:
 
     def hist_ratios(self, field1_name, field2_name):
 
-        fields1, fields2 = map(self.hist_fields, (field1_name, field2_name))
-        ratios = self.impute(1, fields1, fields2, func=self.divide)
+        ratios = self.hist_derived([('ratio', divide, field1_name, field2_name)])
 
-        return sorted(ratios, reverse=True)
+        return ratios['ratio']
 
-    def divide(self, numer, denom):
+    def hist_derived(self, specs=None):
+        """ Derived quarterly fields, all computed in one pass
+        INPUT: specs, list of (name, func, field1, field2), default DERIVED
+        OUTPUT: dict of name => list of (period, value) tuples, latest first
+        NOTES: each field's quarters are loaded once however many specs
+        use it, then joined on period (see align, derive)
+        """
 
-        return numer / denom
+        specs = specs or self.DERIVED
+        names = set(name for spec in specs for name in spec[2:])
+        quarters = dict((name, self.hist_quarters(name)) for name in names)
+        table = align(quarters)
+        derived = derive(table, specs, value=itemgetter(1))
 
+        return dict((name, sorted(rows, reverse=True))
+            for name, rows in derived.items())
 
     def impute(self, sign, field1, field2, func=None):
         """ Adds or subtracts values at corresponding enddates, disregarding
@@ -404,34 +672,22 @@ class Company:
         """
 
         if not func:
-            func = lambda x, y: x + sign * y
+            func = add if sign == 1 else subtract
 
-        periods = list(set(map(lambda x: x[0], field1 + field2)))
-        output = []
-        for period in periods:
-            first = filter(lambda x: x[0] == period, field1)
-            if len(first) == 1:
-                second = filter(lambda x: x[0] == period, field2)
-                if len(second) == 1:
-                    output.append((first[0][:2], func(first[0][-1], second[0][-1])))
+        table = align({1: field1, 2: field2})
 
-        return output
+        return derive(table, [(0, func, 1, 2)], label=itemgetter(slice(2)))[0]
 
     def inc_days(self, date, num):
 
-        dt = datetime.datetime.strptime(date, DFMT)
-        dt += datetime.timedelta(days=num)
-        date = dt.strftime(DFMT)
-
-        return date
+        return facts.ordinal_date(facts.date_ordinal(date) + num)
 
 
     def per_to_delta(self, period):
         """Takes end_date, start_date list or tuple and delta (# days)"""
         
         end_date = period[0]
-        period = map(lambda x: datetime.datetime.strptime(x, DFMT), period)
-        delta = reduce(lambda x, y: x - y, period).days
+        delta = reduce(lambda x, y: x - y, map(facts.date_ordinal, period))
         
         return delta
 
@@ -457,15 +713,13 @@ class Company:
 
     def hist_quarters(self, query):
 
-        hist = self.hist_fields(query)
-        quarters = [el[1:] for el in filter(lambda x: x[0] < 100, hist)]
-        enddates = list(set(map(lambda x: x[0][0], quarters)))
-        
-        results = []
-        for enddate in enddates:
-            results.append(filter(lambda x: x[0][0]==enddate, quarters)[0])
+        # first quarter-length (period, value, fdate) per end date
+        results = {}
+        for el in self.hist_fields(query):
+            if el[0] < 100 and el[1][0] not in results:
+                results[el[1][0]] = el[1:]
 
-        return results
+        return results.values()
 
     def truncate_hist(self, fields):
         """Truncates from first period longer than 100 days """
@@ -488,38 +742,52 @@ class Company:
         return new_delta, new_value
 
     def impute_periods(self, fields, average=False):
+        """ Imputes periods from pairs of (delta, (end, start), value, fdate)
+        fields: subtracts a shorter period sharing the end date or start
+        date of a longer-than-quarter one, and chains periods where one
+        starts the day after the other ends (up to a year in total).
+        NOTES: Dates are compared as day ordinals and fields are indexed by
+        end and start date, so each field is only compared with the fields
+        it can pair with. Candidates are visited in the same order as a
+        comparison against every field would, so results (and their order)
+        are unchanged.
+        """
 
         imputed = []
         # remove duplicates:
         fields = list(set(fields))
-        # iterate backwords to avoid interacting with new items
-        for el in fields:
+        ends = [facts.date_ordinal(el[1][0]) for el in fields]
+        starts = [facts.date_ordinal(el[1][1]) for el in fields]
+        by_end, by_start = {}, {}
+        for ix in xrange(len(fields)):
+            by_end.setdefault(ends[ix], []).append(ix)
+            by_start.setdefault(starts[ix], []).append(ix)
+
+        for ix, el in enumerate(fields):
             fdate = "{}*".format(el[3])
+            end, start = ends[ix], starts[ix]
             # if 'el' non-quarterly, try to impute smaller periods
             if el[0] > 100:
-                for other in fields:
+                for jx in sorted(set(by_end[end] + by_start[start])):
+                    other = fields[jx]
                     # same enddate + 'other' starts later => impute earlier
-                    if other[1][0] == el[1][0] and other[1][1] > el[1][1]:
-                        end = self.inc_days(other[1][1], -1)
-                        start = el[1][1]
+                    if ends[jx] == end and starts[jx] > start:
+                        new_end = facts.ordinal_date(starts[jx] - 1)
                         delta, value = self.impute_period(el, other, -1, average)
-                        imputed.append((delta, (end, start), value, fdate))
+                        imputed.append((delta, (new_end, el[1][1]), value, fdate))
                     # same startdate + 'other' ends before => impute later
-                    if other[1][1] == el[1][1] and other[1][0] < el[1][0]:
-                        end = el[1][0]
-                        start = self.inc_days(other[1][0], 1)
+                    if starts[jx] == start and ends[jx] < end:
+                        new_start = facts.ordinal_date(ends[jx] + 1)
                         delta, value = self.impute_period(el, other, -1, average)
-                        imputed.append((delta, (end, start), value, fdate))
+                        imputed.append((delta, (el[1][0], new_start), value, fdate))
 
-            for other in fields:
-                # try to chain 'el' and 'other' if => 1 year or less
+            # 'other' startdate == ('el' enddate + 1) => chain periods if
+            # => 1 year or less
+            for jx in by_start.get(end + 1, ()):
+                other = fields[jx]
                 if el[0] + other[0] <= 370:
-                    # 'other' startdate == ('el' enddate + 1) => chain periods
-                    if other[1][1] == self.inc_days(el[1][0], 1):
-                        end = other[1][0]
-                        start = el[1][1]
-                        delta, value = self.impute_period(el, other, 1, average)
-                        imputed.append((delta, (end, start), value, fdate))
+                    delta, value = self.impute_period(el, other, 1, average)
+                    imputed.append((delta, (other[1][0], el[1][1]), value, fdate))
 
         # remove duplicates
         imputed = list(set(imputed))
@@ -0,0 +1,122 @@
+import heapq
+import logging
+import os
+import re
+import struct
+import threading
+
+import secmaster
+
+# CONSTANTS
+HOLDERS_DIR = os.environ.get('OPENSEC_HOLDERS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'holders'))
+# posting: manager CIK, period of report as YYYYMMDD, shares, value ($000s)
+POSTING = struct.Struct('<Qiqq')
+# accession numbers of the filings added, one per line
+INDEXED_PATH = os.path.join(HOLDERS_DIR, 'filings')
+LOCK = threading.Lock() # serializes add
+indexed = None # set of INDEXED_PATH accessions, loaded by the first add
+
+def _indexed():
+    global indexed
+    if indexed is None:
+        try:
+            with open(INDEXED_PATH) as f:
+                indexed = set(line.strip() for line in f)
+        except (IOError, OSError):
+            indexed = set()
+
+    return indexed
+
+def _path(cusip):
+    cusip = secmaster.clean_cusip(cusip)
+    return os.path.join(HOLDERS_DIR, cusip[:2], cusip)
+
+def _period(as_of):
+    """'2014-03-31' => 20140331, or None if as_of isn't a date"""
+
+    if not re.match(r'\d{4}-\d{2}-\d{2}$', as_of or ''):
+        return None
+
+    return int(as_of.replace('-', ''))
+
+def add(cik, as_of, holdings, accession=None):
+    """Appends a filing's positions to the cusip => holders index
+    INPUT: manager cik, period of report (YYYY-MM-DD), holdings as
+    [issuer, cusip, value, shares, option] rows from the crawler and the
+    filing's accession number
+    NOTES: put/call rows are skipped and duplicate cusips summed. Each cusip
+    has its own append-only file of fixed-width POSTING records. Filings
+    are added once: accessions already in INDEXED_PATH are skipped, so
+    re-crawls don't grow the files (an amendment is a new accession and
+    its postings replace the period's; see get)."""
+
+    period = _period(as_of)
+    if period is None or not cik:
+        return
+    with LOCK:
+        if accession and accession in _indexed():
+            return
+        _add(cik, period, holdings, accession)
+
+def _add(cik, period, holdings, accession):
+
+    positions = {}
+    for issuer, cusip, value, shares, option in holdings:
+        if option or not cusip:
+            continue
+        value = int(str(value).replace(",", ""))
+        cusip = secmaster.clean_cusip(cusip)
+        held = positions.get(cusip, (0, 0))
+        positions[cusip] = (held[0] + int(shares or 0), held[1] + value)
+
+    try:
+        for cusip, (shares, value) in positions.items():
+            path = _path(cusip)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'ab') as f:
+                f.write(POSTING.pack(int(cik), period, shares, value))
+        if accession:
+            if not os.path.isdir(HOLDERS_DIR):
+                os.makedirs(HOLDERS_DIR)
+            with open(INDEXED_PATH, 'a') as f:
+                f.write(accession + '\n')
+            indexed.add(accession)
+    except (IOError, OSError) as e:
+        logging.warning("holders index not updated: %s", e)
+
+def get(cusip):
+    """Returns list of (cik, as_of, shares, value) holding cusip, from a
+    single read of its postings file; later postings for the same manager
+    and period replace earlier ones"""
+
+    try:
+        with open(_path(cusip), 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return []
+
+    postings = {}
+    for offset in xrange(0, len(data) - POSTING.size + 1, POSTING.size):
+        cik, period, shares, value = POSTING.unpack_from(data, offset)
+        postings[(cik, period)] = (shares, value)
+
+    results = []
+    for (cik, period), (shares, value) in postings.items():
+        as_of = "{}-{}-{}".format(str(period)[:4], str(period)[4:6],
+            str(period)[6:])
+        results.append(("{:010d}".format(cik), as_of, shares, value))
+
+    return results
+
+def top(cusip, limit=10):
+    """Largest holders of cusip by shares, using each manager's latest
+    period of report. OUTPUT: list of (cik, as_of, shares, value)"""
+
+    latest = {}
+    for posting in get(cusip):
+        if posting[0] not in latest or posting[1] > latest[posting[0]][1]:
+            latest[posting[0]] = posting
+
+    return heapq.nlargest(limit, latest.values(), key=lambda x: x[2])
@@ -0,0 +1,146 @@
+from array import array
+import heapq
+
+class Holdings:
+    """Columnar 13F holdings: parallel lists of interned issuer, cusip and
+    option strings, and typed arrays of market values ($000s) and shares.
+    Row i is (issuers[i], cusips[i], values[i], shares[i], options[i])."""
+
+    def __init__(self):
+        self.issuers = []
+        self.cusips = []
+        self.values = array('l')
+        self.shares = array('l')
+        self.options = []
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """INPUT: [issuer, cusip, value, shares, option] rows as returned by
+        the crawler; values may be strings with commas, shares and option may
+        be None"""
+
+        holdings = cls()
+        for issuer, cusip, value, shares, option in rows:
+            holdings.append(issuer, cusip, int(str(value).replace(",", "")),
+                shares or 0, option or '')
+
+        return holdings
+
+    def append(self, issuer, cusip, value, shares, option):
+        self.issuers.append(intern_str(issuer))
+        self.cusips.append(intern_str(cusip))
+        self.values.append(value)
+        self.shares.append(shares)
+        self.options.append(intern_str(option))
+
+    def row(self, ix):
+        return [self.issuers[ix], self.cusips[ix], self.values[ix],
+            self.shares[ix], self.options[ix]]
+
+    def rows(self):
+        return [self.row(ix) for ix in xrange(len(self))]
+
+    def aggregate(self):
+        """Sums values and shares over rows with the same cusip and option
+        (puts and calls stay separate from the shares), keeping the issuer
+        and order of first appearance. OUTPUT: new Holdings"""
+
+        grouped = Holdings()
+        index = {}
+        for ix in xrange(len(self)):
+            key = (self.cusips[ix], self.options[ix])
+            group = index.get(key)
+            if group is None:
+                index[key] = len(grouped)
+                grouped.append(self.issuers[ix], self.cusips[ix],
+                    self.values[ix], self.shares[ix], self.options[ix])
+            else:
+                grouped.values[group] += self.values[ix]
+                grouped.shares[group] += self.shares[ix]
+
+        return grouped
+
+    def total(self):
+        return sum(self.values)
+
+    def weights(self):
+        """Percent of total market value per row, as array('d')"""
+
+        total = self.total()
+        scale = 100. / total if total else 0.
+
+        return array('d', (value * scale for value in self.values))
+
+    def top(self, limit, offset=0):
+        """Row indexes ranked offset to offset + limit by market value.
+        Only partially sorts; ties keep filing order."""
+
+        ranked = heapq.nlargest(offset + limit, xrange(len(self)),
+            key=self.values.__getitem__)
+
+        return ranked[offset:]
+
+def intern_str(value):
+    """Interns byte strings so repeated cusips/issuers share one object;
+    unicode (from XML filings) is first encoded if it's plain ASCII"""
+
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+
+    return intern(value)
+
+# Position changes reported by diff()
+NEW, EXITED, INCREASED, DECREASED = 'new', 'exited', 'increased', 'decreased'
+
+def diff(old, new):
+    """Compares two aggregated Holdings (see Holdings.aggregate) by cusip
+    and put/call, with a hash join so it runs in O(len(old) + len(new))
+    OUTPUT: yields (change, issuer, cusip, option, old shares, new shares,
+    old value, new value) for each changed position, new filing's rows
+    first in filing order, then exited positions
+    NOTES: Increases/decreases compare shares, or market value for rows
+    without a share count. Unchanged positions aren't yielded."""
+
+    index = dict(((cusip, option), ix) for ix, (cusip, option)
+        in enumerate(zip(old.cusips, old.options)))
+    matched = set()
+
+    for ix in xrange(len(new)):
+        key = (new.cusips[ix], new.options[ix])
+        jx = index.get(key)
+        if jx is None:
+            yield (NEW, new.issuers[ix], key[0], key[1], 0, new.shares[ix],
+                0, new.values[ix])
+            continue
+
+        matched.add(jx)
+        if new.shares[ix] or old.shares[jx]:
+            delta = new.shares[ix] - old.shares[jx]
+        else:
+            delta = new.values[ix] - old.values[jx]
+        if delta:
+            yield (INCREASED if delta > 0 else DECREASED, new.issuers[ix],
+                key[0], key[1], old.shares[jx], new.shares[ix],
+                old.values[jx], new.values[ix])
+
+    for jx in xrange(len(old)):
+        if jx not in matched:
+            yield (EXITED, old.issuers[jx], old.cusips[jx], old.options[jx],
+                old.shares[jx], 0, old.values[jx], 0)
+
+def diff_series(filings):
+    """Diffs each consecutive pair of Holdings in filings (oldest first)
+    OUTPUT: yields (ix, change row) where ix is the index in filings of the
+    newer filing of the pair and change row is as yielded by diff()"""
+
+    for ix in xrange(1, len(filings)):
+        for change in diff(filings[ix - 1], filings[ix]):
+            yield ix, change
@@ -1,20 +1,31 @@
 # Other modules in this directory
 import crawler
+import fetch
 import fins
+import holders
+import holdings
+import secmaster
 import stocks
+import warm
 
 # Python libraries 
 import datetime
+import heapq
 import jinja2
+import json
 import logging
 from operator import itemgetter
 import os
+import pickle
 import re
+import time
+import zlib
 
 import webapp2
 
 from google.appengine.runtime import DeadlineExceededError
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 # Template utils
@@ -23,6 +34,15 @@ jinja_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(template_dir),
     autoescape=True)
 
+def fmt_thousands(value):
+    return "{:,}".format(value)
+
+def fmt_pct(value):
+    return "{:.1f}%".format(value)
+
+jinja_env.filters['thousands'] = fmt_thousands
+jinja_env.filters['pct'] = fmt_pct
+
 def render_str(template, **params):
     t = jinja_env.get_template(template)
     return t.render(params)
@@ -30,59 +50,187 @@ def render_str(template, **params):
 def secs_key(group = 'default'):
     return ndb.Key('secs', group)
 
+TICKER_CACHE = fetch.LRUCache(50000) # cusip => ticker ('' if unknown)
+MASTER = secmaster.load() # operator supplied index; None if not built
+
+def resolve_tickers(cusips):
+    """Looks up tickers for many cusips at once
+    INPUT: iterable of cusips (duplicates allowed)
+    OUTPUT: dict of cusip => ticker ('' if not found)
+    NOTES: Checks the in-process cache and local security master, then the
+    datastore in one batch, then runs cusip_to_ticker concurrently for the
+    rest and saves new mappings in one batch put."""
+
+    cusips = set(cusips)
+    tickers = TICKER_CACHE.get_multi(cusips)
+
+    if MASTER:
+        for cusip in cusips:
+            if cusip not in tickers:
+                ticker = MASTER.get(cusip)
+                if ticker:
+                    tickers[cusip] = ticker
+
+    missing = [cusip for cusip in cusips if cusip not in tickers]
+    if missing:
+        keys = [ndb.Key(Security, cusip, parent=secs_key())
+            for cusip in missing]
+        for cusip, security in zip(missing, ndb.get_multi(keys)):
+            if security:
+                tickers[cusip] = security.ticker
+
+    # Securities saved before they were keyed by cusip (IN takes <= 30 values)
+    missing = [cusip for cusip in cusips if cusip not in tickers]
+    if missing:
+        queries = [Security.query(Security.cusip.IN(missing[i:i + 30]),
+            ancestor=secs_key()).fetch_async()
+            for i in xrange(0, len(missing), 30)]
+        for query in queries:
+            for security in query.get_result():
+                tickers[security.cusip] = security.ticker
+
+    # On db miss run cusip_to_ticker and add hits to db
+    missing = [cusip for cusip in cusips if cusip not in tickers]
+    if missing:
+        found = fetch.pmap(stocks.cusip_to_ticker, missing)
+        securities = []
+        for cusip, ticker in zip(missing, found):
+            tickers[cusip] = ticker
+            if ticker:
+                securities.append(Security(id=cusip, parent=secs_key(),
+                    cusip=cusip, ticker=ticker))
+        ndb.put_multi(securities)
+
+    TICKER_CACHE.set_multi(tickers)
+
+    return tickers
+
 def clean_filing(filing):
-    """Adds up market value and percentages column and sorts by market value
+    """Sums holdings over duplicate cusips
     INPUT: list of holdings
-    OUPUT: cleaned and sorted list and total market value"""
-
-    clean_filing = []
-    mv_tot = ct = pct_tot = 0
-
-    # First pass creates clean list, adds/counts market value and adds tickers
-    # TODO: sum over duplicate cusips
-    for holding in filing:
-        row = []
-        row += holding[:2]
-        cusip = holding[1]
-
-        # Look in db...
-        security = Security.query(
-            Security.cusip == cusip, ancestor=secs_key()).get()
-        if security:
-            ticker = security.ticker
-        else:
-            # On db miss run cusip_to_ticker...
-            ticker = stocks.cusip_to_ticker(cusip)
-            if ticker:
-                # ... and add to db: 
-                security = Security(parent=secs_key())
-                security.cusip=cusip
-                security.ticker=ticker
-                security.put()
-
-        row.append(ticker)
-        mv = int(str(holding[2]).replace(",", ""))
-        mv_tot += mv
-        ct += 1
-        row.append(mv)
-        row.append('')
-        row.append(holding[4])
-        clean_filing.append(row)
-    
-    # Sort on market value
-    clean_filing.sort(key=itemgetter(3), reverse=True)
-
-    # 2nd pass adds percentages and formatting
-    for row in clean_filing:
-        pct = 100. * row[3] / mv_tot
-        pct_tot += pct
-        row[3] = "{:,}".format(row[3])
-        row[4] = "{:.1f}%".format(pct)
-
-    mv_tot = "{:,}".format(mv_tot)
-    pct_tot = "{:.1f}%".format(pct_tot)
-
-    return clean_filing, ct, mv_tot, pct_tot
+    OUPUT: holdings.Holdings, one row per cusip (and put/call)"""
+
+    return holdings.Holdings.from_rows(filing).aggregate()
+
+FILING_CACHE = fetch.LRUCache(64) # url => (Holdings, as_of, mv_rep, ct_rep)
+
+def load_filing(url):
+    """Returns (clean_filing holdings, as_of, mv_rep, ct_rep) for filing url,
+    reusing recently loaded filings in this process"""
+
+    filing = FILING_CACHE.get(url)
+    if filing is None:
+        rows, asof, mv_rep, ct_rep = get_holdings(url)
+        filing = (clean_filing(rows), asof, mv_rep, ct_rep)
+        FILING_CACHE.set(url, filing)
+
+    return filing
+
+# filing index paths on www.sec.gov; slugs come from requests and crawled
+# pages, and what's crawled is added to the shared holders index
+SLUG_P = re.compile(r'/Archives/edgar/data/\d+/[\w.-]+(?:/[\w.-]+)*\Z')
+
+def is_filing_slug(slug):
+    return bool(SLUG_P.match(slug or '')) and '..' not in slug
+
+def filing_url(slug):
+    """sec.gov url of filing slug; ValueError if it isn't an EDGAR path"""
+
+    if not is_filing_slug(slug):
+        raise ValueError("not an EDGAR filing path: {!r}".format(slug))
+
+    return "http://www.sec.gov{}".format(slug)
+
+def holdings_key(url):
+    return "holdings|{}".format(url)
+
+def get_holdings(url):
+    """Crawls 13F filing at url, caching the parsed result in memcache
+    OUTPUT: (holdings, as_of, mv_rep, ct_rep), as from crawler.crawl_filing"""
+
+    key = holdings_key(url)
+    cached = memcache.get(key)
+    if cached:
+        return pickle.loads(zlib.decompress(cached))
+
+    result = crawler.crawl_filing(url)
+    try:
+        memcache.set(key, zlib.compress(pickle.dumps(result, 2)))
+    except ValueError: # over memcache's 1MB limit; just don't cache
+        logging.info("holdings for %s too large to cache", url)
+
+    return result
+
+# ticker => dict of meta and metrics; fresh for a day and then served while
+# refreshed for up to 29 more (fetch.MAX_EXPIRY in all). Tickers without
+# filings (IndexError) are remembered for 15 minutes. Stale tickers are
+# rebuilt in a deferred task (revalidate_company): the runtime holds each
+# response until the request's threads finish.
+COMPANY_CACHE = fetch.StaleCache(memcache, ttl=24 * 3600,
+    stale_ttl=29 * 24 * 3600, negative_ttl=15 * 60, errors=(IndexError,),
+    spawn=lambda ticker, build: deferred.defer(revalidate_company, ticker),
+    prefix='company|')
+
+def revalidate_company(ticker):
+    """Deferred task: rebuilds stale ticker's COMPANY_CACHE entry"""
+
+    COMPANY_CACHE.revalidate(ticker, lambda: build_company(ticker))
+
+def build_company(ticker):
+
+    company = fins.Company(ticker, store=FilingStore())
+    company.get_metrics()
+
+    # newest filing listed, parsed or not, for new_filing
+    listed = max([date for date, url in company.filings_list] or [''])
+
+    return dict(meta=company.meta, metrics=company.metrics, listed=listed)
+
+POPULARITY = warm.Popularity(memcache) # requests per ticker and manager CIK
+WARM_AHEAD = 2 * 3600 # seconds before expiry that entries are warmed
+
+def new_filing(company):
+    """True if browse-edgar lists a 10-/20- XBRL filing of a cached company
+    (from build_company) filed after those it was built from"""
+
+    cik, listed = company['meta'].get('cik'), company.get('listed')
+    if not (cik and listed):
+        return False
+    latest = fins.latest_filing(cik)
+
+    return bool(latest and latest > listed)
+
+def warm_company(ticker):
+    """Rebuilds ticker's COMPANY_CACHE entry if it's missing, expires
+    within WARM_AHEAD or misses a new filing; True if rebuilt. Tickers
+    cached as having no filings (negative entries) aren't rebuilt here;
+    they expire after COMPANY_CACHE's negative_ttl."""
+
+    entry = COMPANY_CACHE.entry(ticker)
+    if entry is not None:
+        company, fresh_until, error = entry
+        if error is not None or (fresh_until - time.time() > WARM_AHEAD
+                and not new_filing(company)):
+            return False
+
+    COMPANY_CACHE.refresh(ticker, lambda: build_company(ticker))
+    return True
+
+def warm_manager(cik):
+    """Crawls the newest 13F filing of manager cik through Filing (which
+    also resolves its top tickers) unless it's in memcache; True if
+    crawled. New filings are found as the newest in the filings list."""
+
+    url = crawler.get_manager(cik)
+    if not isinstance(url, basestring):
+        return False
+    manager, cik, filings = crawler.get_filings_list(url)
+    if not filings or memcache.get(holdings_key(
+            filing_url(filings[0][0]))) is not None:
+        return False
+
+    Filing(filings[0][0])
+    return True
 
 class Handler(webapp2.RequestHandler):
 
@@ -92,24 +240,111 @@ class Handler(webapp2.RequestHandler):
     def render(self, template, **kw):
         self.write(render_str(template, **kw))
 
+    def number(self, name, default, convert=int, low=None, high=None):
+        """Query parameter name converted by convert (default if missing),
+        clamped to low and high; answers 400 if it doesn't convert to a
+        finite number"""
+
+        raw = self.request.get(name)
+        try:
+            value = convert(raw) if raw else default
+            if value != value or abs(value) == float('inf'): # nan, inf
+                raise ValueError(raw)
+        except ValueError:
+            self.abort(400, detail="bad {} parameter".format(name))
+        if low is not None:
+            value = max(value, low)
+        if high is not None:
+            value = min(value, high)
+
+        return value
+
+    def date(self, name, default=None):
+        """Query parameter name as a datetime.date (default if missing);
+        answers 400 if it isn't a YYYY-MM-DD date"""
+
+        raw = self.request.get(name)
+        try:
+            return (datetime.datetime.strptime(raw, '%Y-%m-%d').date()
+                if raw else default)
+        except ValueError:
+            self.abort(400, detail="{} must be a YYYY-MM-DD date".format(name))
+
 class Security(ndb.Model):
     cusip = ndb.StringProperty(required = True)
     ticker = ndb.StringProperty(required = True)
 
+class ParsedFiling(ndb.Model):
+    """fins.Company filing dict (date, url, fields); id is accession number"""
+    filing = ndb.PickleProperty(required = True)
+
+class FilingStore:
+    """Datastore-backed store of parsed filings for fins.Company"""
+
+    def get_multi(self, accessions):
+        keys = [ndb.Key(ParsedFiling, acc) for acc in accessions]
+        entities = ndb.get_multi(keys)
+        return dict((acc, entity.filing)
+            for acc, entity in zip(accessions, entities) if entity)
+
+    def set_multi(self, filings):
+        ndb.put_multi([ParsedFiling(id=acc, filing=filing)
+            for acc, filing in filings.items()])
+
 
 class Filing:
 
-    def __init__(self, slug):
+    def __init__(self, slug, show=20):
         self.slug = slug
-        self.url = "http://www.sec.gov{}".format(self.slug)
-        holdings, asof, mv_rep, ct_rep = crawler.crawl_filing(self.url)
-        body, ct, mv_tot, pct_tot = clean_filing(holdings)
-        meta = dict(asof=asof, count=ct, mv_tot=mv_tot, pct_tot=pct_tot,
-                 mv_rep=mv_rep, ct_rep=ct_rep)
-        self.body = body
-        self.meta = meta
-        mv_rep = self.meta['mv_rep']
-        self.meta['mv_rep'] = "{:,}".format(mv_rep) if mv_rep else 'None'
+        self.url = filing_url(self.slug)
+        self.holdings, asof, mv_rep, ct_rep = load_filing(self.url)
+        self.weights = self.holdings.weights()
+        mv_tot = self.holdings.total()
+        pct_tot = sum(self.weights)
+        self.meta = dict(asof=asof, count=len(self.holdings), mv_tot=mv_tot,
+            pct_tot=pct_tot, mv_rep=mv_rep, ct_rep=ct_rep)
+        self.body = self.rows(0, show)
+
+    def rows(self, offset, limit):
+        """Rows ranked offset to offset + limit by market value
+        OUTPUT: list of [issuer, cusip, ticker, value, weight, option]
+        NOTES: Only the top offset + limit holdings are sorted, and tickers
+        are only resolved for the rows returned"""
+
+        top = self.holdings.top(limit, offset)
+        cusips = self.holdings.cusips
+        tickers = resolve_tickers([cusips[ix] for ix in top])
+
+        rows = []
+        for ix in top:
+            rows.append([self.holdings.issuers[ix], cusips[ix],
+                tickers[cusips[ix]], self.holdings.values[ix],
+                self.weights[ix], self.holdings.options[ix]])
+
+        return rows
+
+    def returns(self, start=None, end=None):
+        """Returns of each holding from start (default period of report) to
+        end (default today), from the local price store
+        OUTPUT: list of % returns aligned with self.holdings (None for puts,
+        calls and unpriced rows), % return of the priced holdings weighted
+        by market value, and % of market value priced"""
+
+        start = start or self.meta['asof']
+        end = end or datetime.date.today()
+        cusips = self.holdings.cusips
+        tickers = resolve_tickers(set(cusips))
+        changes = stocks.returns(tickers.values(), start, end)
+
+        results = [None if option else changes.get(tickers[cusip])
+            for cusip, option in zip(cusips, self.holdings.options)]
+        priced = [(weight, result) for weight, result
+            in zip(self.weights, results) if result is not None]
+        pct_priced = sum(weight for weight, result in priced)
+        total = (sum(weight * result for weight, result in priced)
+            / pct_priced if pct_priced else None)
+
+        return results, total, pct_priced
 
 class Search(Handler):
 
@@ -140,7 +375,14 @@ class Search(Handler):
         if self.filing_slug:
             self.params['manager_full'] = self.request.get('manager_full')
             
-            filing = Filing(self.filing_slug)
+            if not is_filing_slug(self.filing_slug):
+                self.render('search.html', message='Not an EDGAR filing',
+                    error="error")
+                return
+            filing = Filing(self.filing_slug, show=self.params['show'])
+            cik = re.search(r'/data/(\d+)/', self.filing_slug)
+            if cik:
+                POPULARITY.hit('manager', "{:010d}".format(int(cik.group(1))))
 
             self.params['filing'] = filing
             self.render("manager.html", **self.params)
@@ -169,41 +411,154 @@ class Search(Handler):
 
             if isinstance(self.mgr_url, basestring):
                 manager, cik, filings = crawler.get_filings_list(self.mgr_url)
+                POPULARITY.hit('manager', cik.replace('CIK=', ''))
                 size = len(filings)
                 self.render('search.html', **dict(manager_full=manager,
                     filings=filings, message='{} filings found for {}'.\
                     format(size, manager)))
 
+class Holdings(Handler):
+
+    def get(self):
+        """JSON page of a filing's holdings, by filing_slug, offset and limit"""
+
+        slug = self.request.get('filing_slug')
+        if not is_filing_slug(slug):
+            self.abort(400, detail="filing_slug must be an EDGAR filing path")
+        offset = self.number('offset', 0, low=0)
+        limit = self.number('limit', 100, low=1, high=1000)
+
+        filing = Filing(slug, show=0)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(dict(offset=offset, count=filing.meta['count'],
+            rows=filing.rows(offset, limit))))
+
+class Returns(Handler):
+
+    def get(self):
+        """JSON of a filing's holding returns (see Filing.returns)
+        INPUT: filing_slug, start (YYYY-MM-DD, default the period of report)
+        and end (default today)
+        OUTPUT: {"asof", "total" (% return weighted by market value),
+        "priced" (% of market value priced), "rows": [[issuer, cusip,
+        option, weight, % return or null], ...] in filing order}"""
+
+        slug = self.request.get('filing_slug')
+        if not is_filing_slug(slug):
+            self.abort(400, detail="filing_slug must be an EDGAR filing path")
+        start = self.date('start')
+        end = self.date('end')
+
+        filing = Filing(slug, show=0)
+        results, total, priced = filing.returns(start, end)
+        rows = [list(row) for row in zip(filing.holdings.issuers,
+            filing.holdings.cusips, filing.holdings.options, filing.weights,
+            results)]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(dict(asof=filing.meta['asof'], total=total,
+            priced=priced, rows=rows)))
+
+class Prices(Handler):
+
+    def get(self):
+        """Columnar JSON of a ticker's adjusted closes for the price chart
+        INPUT: ticker, points (resolution, e.g. the chart's pixel width;
+        default 600) and years (default 5, 0 for the full history)
+        OUTPUT: {"days": [days since 1970-01-01], "closes": [...]}"""
+
+        ticker = self.request.get('ticker')
+        points = self.number('points', 600, low=3, high=5000)
+        years = self.number('years', 5, float, low=0)
+
+        prices = stocks.chart_prices(ticker, points, years)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(prices, separators=(',', ':')))
+
+class Changes(Handler):
+
+    def get(self):
+        """Position changes between a manager's consecutive 13F filings
+        INPUT: mgrurl (manager's filings list url) and quarters (number of
+        most recent filing pairs to compare, default 1; 13F-HR/A amendments
+        are skipped)
+        OUTPUT: one JSON object per line, per changed position"""
+
+        mgr_url = self.request.get('mgrurl')
+        quarters = self.number('quarters', 1, low=1, high=40)
+
+        manager, cik, filings = crawler.get_filings_list(mgr_url)
+        cik = cik.split('=')[-1] # 'CIK=0001234567'
+        # amendments restate or add to a quarter; diff original filings
+        filings = [f for f in filings
+            if f[2].upper() == '13F-HR' and is_filing_slug(f[0])]
+        filings = list(reversed(filings[:quarters + 1])) # oldest first
+        loaded = fetch.pmap(lambda f: load_filing(filing_url(f[0])), filings)
+
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        changes = holdings.diff_series([el[0] for el in loaded])
+        for ix, change in changes:
+            change, issuer, cusip, option, shs0, shs1, mv0, mv1 = change
+            self.write(json.dumps(dict(cik=cik, asof=loaded[ix][1],
+                prior_asof=loaded[ix - 1][1], change=change, issuer=issuer,
+                cusip=cusip, option=option, shares=[shs0, shs1],
+                value=[mv0, mv1])) + '\n')
+
 class CompanyResults(Search):
 
     def get(self, ticker):
 
         self.params = {'meta': {}}
 
-        # look in memcache for company dictionary
-        company = memcache.get(ticker)
-        if company:
+        try:
+            company = COMPANY_CACHE.get(ticker.upper(),
+                lambda: build_company(ticker))
             self.params['meta'] = company['meta']
             self.params['metrics'] = company['metrics']
+            POPULARITY.hit('ticker', ticker.upper())
+        except (DeadlineExceededError, IndexError) as e:
+            self.params['message'] = 'Error retrieving filings'
+            self.params['error'] = 'error'
+            self.params['meta']['ticker'] = ticker.upper()
 
-        # try to get company object using fins module
-        if not company:
-            try:
-                company = fins.Company(ticker)
-                company.get_metrics()
-                memcache.set(ticker, dict(meta=company.meta, metrics=company.metrics))
-                self.params['meta'] = company.meta
-                self.params['metrics'] = company.metrics
-            except (DeadlineExceededError, IndexError) as e:
-                self.params['message'] = 'Error retrieving filings'
-                self.params['error'] = 'error'
-                self.params['meta']['ticker'] = ticker.upper()
-        
-        self.params['prices'] = stocks.json_prices(ticker)[:252*5] # 5 year of data
+        self.params['holders'] = self.get_holders(ticker)
         self.render("company.html", **self.params)
 
+    def get_holders(self, ticker, limit=10):
+        """Top institutional holders of ticker's cusips from the holders index
+        OUTPUT: list of (cik, as_of, shares, value), largest first"""
+
+        securities = Security.query(Security.ticker == ticker.upper(),
+            ancestor=secs_key()).fetch(10)
+        cusips = set(security.cusip for security in securities)
+        found = [posting for cusip in cusips for posting in holders.top(cusip, limit)]
+
+        return sorted(found, key=itemgetter(2), reverse=True)[:limit]
+
+class Warm(Handler):
+
+    def get(self):
+        """Cron job (cron.yaml): warms the caches of the most requested
+        tickers and managers; top, workers and budget override warm.TOP,
+        warm.WORKERS and warm.BUDGET"""
+
+        top = self.number('top', warm.TOP, low=0)
+        workers = self.number('workers', warm.WORKERS, low=1)
+        budget = self.number('budget', warm.BUDGET, float, low=0)
+        summary = warm.run(POPULARITY,
+            dict(ticker=warm_company, manager=warm_manager), top, workers,
+            budget)
+        logging.info("cache warmer: %s", summary)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(summary))
+
 app = webapp2.WSGIApplication(
     [
+    ('/holdings', Holdings),
+    ('/changes', Changes),
+    ('/prices', Prices),
+    ('/returns', Returns),
+    ('/tasks/warm', Warm),
     ('/(\D+)', CompanyResults),
     ('/?.*', Search)
     ], debug=True)
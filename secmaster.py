@@ -0,0 +1,147 @@
+""" Local CUSIP => ticker security master.
+
+The operator supplies a CSV with cusip and ticker columns; build() sorts it
+into fixed-width records (9 character cusip, space padded ticker, newline)
+that load() memory-maps and binary searches in place, so nothing is parsed
+into Python objects at startup.
+
+    python secmaster.py securities.csv [secmaster.idx]
+"""
+
+import bisect
+import csv
+import logging
+import os
+import re
+import sys
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+
+# CONSTANTS
+MASTER_PATH = os.environ.get('OPENSEC_SECMASTER',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'secmaster.idx'))
+CUSIP_LEN = 9
+TICKER_LEN = 11
+RECORD_LEN = CUSIP_LEN + TICKER_LEN + 1 # trailing newline
+
+def clean_cusip(cusip):
+    """ Strips separators (e.g. '037833-10-0') and upper-cases """
+
+    if cusip.isalnum():
+        return cusip.upper()
+
+    return re.sub(r'[^0-9A-Za-z]', '', cusip).upper()
+
+class Cusips:
+    """ Sequence view of the cusip column of the records, for bisect """
+
+    def __init__(self, data, count):
+
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+
+        return self.count
+
+    def __getitem__(self, ix):
+
+        start = ix * RECORD_LEN
+        return self.data[start:start + CUSIP_LEN]
+
+class Master:
+    """ Sorted fixed-width cusip/ticker records, memory-mapped if possible
+    (else read into a single string). """
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as f:
+            if mmap and os.path.getsize(path):
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = f.read()
+
+        self.cusips = Cusips(self.data, len(self.data) // RECORD_LEN)
+
+    def __len__(self):
+
+        return len(self.cusips)
+
+    def ticker(self, ix):
+
+        start = ix * RECORD_LEN + CUSIP_LEN
+        return self.data[start:start + TICKER_LEN].rstrip()
+
+    def get(self, cusip, default=None):
+        """ Returns ticker for a 9 character cusip, else default """
+
+        cusip = clean_cusip(cusip)
+        ix = bisect.bisect_left(self.cusips, cusip)
+        if ix < len(self.cusips) and self.cusips[ix] == cusip:
+            return self.ticker(ix)
+
+        return default
+
+    def issuer(self, prefix):
+        """ Returns list of (cusip, ticker) for all issues of a 6 character
+        issuer prefix (or any shorter prefix) """
+
+        prefix = clean_cusip(prefix)
+        ix = bisect.bisect_left(self.cusips, prefix)
+        results = []
+        while ix < len(self.cusips) and self.cusips[ix].startswith(prefix):
+            results.append((self.cusips[ix], self.ticker(ix)))
+            ix += 1
+
+        return results
+
+def load(path=MASTER_PATH):
+    """ Returns Master for path, or None if no index has been built """
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        return Master(path)
+    except (IOError, OSError) as e:
+        logging.warning("security master not loaded: %s", e)
+        return None
+
+def build(csv_path, path=MASTER_PATH):
+    """ Writes sorted index at path from a CSV of cusips and tickers.
+    Uses columns named 'cusip' and 'ticker' if there is such a header,
+    else the first two columns. Skips rows with invalid cusips or tickers
+    that don't fit; later duplicates of a cusip win.
+    OUTPUT: number of records written """
+
+    records = {}
+    with open(csv_path, 'rb') as f:
+        rows = csv.reader(f)
+        cusip_ix, ticker_ix = 0, 1
+        for ix, row in enumerate(rows):
+            header = ix == 0 and [col.strip().lower() for col in row]
+            if header and 'cusip' in header and 'ticker' in header:
+                cusip_ix, ticker_ix = header.index('cusip'), header.index('ticker')
+                continue
+            if len(row) <= max(cusip_ix, ticker_ix):
+                continue
+            cusip = clean_cusip(row[cusip_ix])
+            ticker = row[ticker_ix].strip().upper()
+            if len(cusip) != CUSIP_LEN or not ticker or len(ticker) > TICKER_LEN:
+                continue
+            records[cusip] = ticker
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for cusip in sorted(records):
+            f.write("{}{}\n".format(cusip, records[cusip].ljust(TICKER_LEN)))
+    os.rename(tmp, path)
+
+    return len(records)
+
+if __name__ == '__main__':
+    print "{} records written".format(build(*sys.argv[1:3]))
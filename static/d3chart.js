@@ -1,176 +1,193 @@
 
 var chart = d3.select(".chart");
 
-var parseDate = d3.time.format("%Y-%m-%d").parse,
-    dateFn = function(d) { return parseDate(d.Date) },
-    closeFn = function(d) { return +d.AdjClose },
-    formatCurrency = d3.format("$,.2f"),
-    formatDate = d3.time.format('%b %d, %Y')
-    next_i = function(data, lookup) {
-        var right_arr = data.filter(function(d) {
-            return dateFn(d) >= lookup
-        });
-        return data.length - right_arr.length;
+var formatCurrency = d3.format("$,.2f"),
+    formatDate = d3.time.format.utc('%b %d, %Y'),
+    formatIsoDate = d3.time.format.utc('%Y-%m-%d'),
+    DAY_MS = 864e5;
+
+// Prices come as columns from /prices, downsampled to about the chart's
+// pixel width: days since 1970-01-01 (ascending) and adjusted closes.
+// Dates are built once; scrubbing binary searches them. The last point is
+// always the latest close, shown in the caption.
+var targetWidth = parseInt(chart.style("width"), 10),
+    url = "/prices?ticker=" + encodeURIComponent(chart.attr("data-ticker")) +
+        "&points=" + targetWidth;
+
+d3.json(url, function(error, prices) {
+    if (error || prices.days.length < 2) return;
+    draw(prices.days.map(function(day) { return new Date(day * DAY_MS) }),
+        prices.closes);
+});
+
+function draw(dates, closes) {
+
+    var n = dates.length,
+        indexes = d3.range(n),
+        last = n - 1,
+        bisectDate = d3.bisector(function(d) { return d }).left;
+
+    var latest = d3.select(".latest-close")
+        .text("Close: " + closes[last] + " ");
+    latest.append("time")
+        .attr("datetime", formatIsoDate(dates[last]))
+        .text("(" + formatIsoDate(dates[last]) + ")");
+
+    var fattest = d3.max(closes.map(function(c) {return formatCurrency(c).length ;}))
+
+    var margin = {top: 10, right: 10, bottom: 20, left: fattest * 7},
+        aspect = 300 / 585,
+        width = targetWidth - margin.left - margin.right, // 585px width
+        height = targetWidth * aspect - margin.top - margin.bottom; // 300px height
+
+    var x = d3.time.scale.utc()
+        .range([0, width])
+        .domain([dates[0], dates[last]]);
+
+    var y = d3.scale.linear()
+        .range([height, 0])
+        .domain([0, d3.max(closes)]);
+
+    var xAxis = d3.svg.axis()
+        .scale(x)
+        .orient("bottom")
+        .tickFormat(d3.time.format.utc('%b %Y'));
+
+    var yAxis = d3.svg.axis()
+        .scale(y)
+        .orient("left")
+        .tickFormat(formatCurrency);
+
+    var line = d3.svg.line()
+        .x(function(i) { return x(dates[i]); })
+        .y(function(i) { return y(closes[i]); });
+
+    var label = function(i) {
+        return formatDate(dates[i]) + ": " + formatCurrency(closes[i]);
     };
 
-var data = JSONData.slice(0, 252*5);
-data.sort(function(a, b) {
-      return dateFn(a) - dateFn(b);
-    });
-var last = data[data.length - 1];
-var fattest = d3.max(data.map(function(d) {return formatCurrency(closeFn(d)).length ;}))
-
-var margin = {top: 10, right: 10, bottom: 20, left: fattest * 7},
-    aspect = 300 / 585,
-    targetWidth = parseInt(chart.style("width"), 10),
-    width = targetWidth - margin.left - margin.right, // 585px width
-    height = targetWidth * aspect - margin.top - margin.bottom; // 300px height
-
-var x = d3.time.scale()
-    .range([0, width])
-    .domain(d3.extent(data.map(dateFn)));
-
-var y = d3.scale.linear()
-    .range([height, 0])
-    .domain([0, d3.max(data.map(closeFn))]);
-
-var xAxis = d3.svg.axis()
-    .scale(x)
-    .orient("bottom")
-    .tickFormat(d3.time.format('%b %Y'));
-
-var yAxis = d3.svg.axis()
-    .scale(y)
-    .orient("left")
-    .tickFormat(formatCurrency);
-
-var line = d3.svg.line()
-    .x(function(d) { return x(dateFn(d)); })
-    .y(function(d) { return y(closeFn(d)); });
-
-var svg = chart.append("svg")
-    .attr("width", width + margin.left + margin.right)
-    .attr("height", height + margin.top + margin.bottom)
-  .append("g")
-    .attr("class", "plot")
-    .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
-
-svg.append("g")
-    .attr("class", "x axis")
-    .attr("transform", "translate(0," + height + ")")
-    .call(xAxis.ticks(d3.time.months, 12))
-  .append("text")
-    .attr("class", "last")
-    .attr("x", width)
-    .attr("y", -10)
-    .style("text-anchor", "end")
-    .text(formatDate(dateFn(last)) + ": " + formatCurrency(closeFn(last)));
-
-svg.append("g")
-    .attr("class", "y axis")
-    .call(yAxis);
-
-svg.append("path")
-    .datum(data)
-    .attr("class", "line")
-    .attr("d", line);
-
-var hoverLineGroup = svg.append("g")
-    .attr("class", "hover-line");
-
-var focus = svg.append("g")
-    .attr("class", "focus")
-    .style("display", "none");
-
-focus.append("circle")
-    .attr("r", 4.5);
-
-var hoverLineVert = hoverLineGroup
-    .append("line")
-      .attr("x1", margin.left)
-      .attr("x2", margin.left)
-      .attr("y1", 0)
-      .attr("y2", height)
-      .style("opacity", 1e-6);
-
-var hoverLineHoriz = hoverLineGroup
-    .append("line")
-      .attr("x1", 0)
-      .attr("x2", width)
-      .attr("y1", 0)
-      .attr("y2", 0)
-      .style("opacity", 1e-6);
-
-chart.on("mouseover", function() {
-}).on("mousemove", adjustHover);
-
-function adjustHover() {
-    var x0, i, d0, d1, d;
-    var mouse_x = d3.mouse(this)[0];
-
-    if (mouse_x < margin.left) {
-        d = data[0]; // focus and crosshairs stick at left side
-    } else if (mouse_x > margin.left + width) {
-        d = data[data.length - 1]; // focus and crosshairs stick at right side
-    } else {
-        x0 = x.invert(mouse_x - margin.left);
-        i = next_i(data, x0);
-        d0 = data[i - 1];
-        d1 = data[i];
-        d = x0 - dateFn(d0) > dateFn(d1) - x0 ? d1 : d0;
-    }
-
-    hoverLineVert
-        .attr("x1", x(dateFn(d)))
-        .attr("x2", x(dateFn(d)))
-        .style("opacity", 0.3);
-    hoverLineHoriz
-        .attr("y1", y(closeFn(d)))
-        .attr("y2", y(closeFn(d)))
-        .style("opacity", 0.3);
-    focus
-        .style("display", null)
-        .attr("transform", "translate(" + x(dateFn(d)) + "," + y(closeFn(d)) + ")")
-    d3.select(".last")
-        .text(formatDate(dateFn(d)) + ": " + formatCurrency(closeFn(d)));
-};
-    
-d3.select(window).on("resize", resize);
-
-function resize() {
-    // update width
-    targetWidth = parseInt(chart.style("width"), 10);
-    width = targetWidth - margin.left - margin.right;
-    height = aspect * targetWidth - margin.top - margin.bottom;
-
-    // update x and y scales
-    x.range([0, width]);
-    y.range([height, 0]);
-
-    // update stuff that uses width, height, x or y
-    d3.selectAll("svg")
+    var svg = chart.append("svg")
         .attr("width", width + margin.left + margin.right)
-        .attr("height", height + margin.top + margin.bottom);
-    d3.selectAll(".plot")
-        .attr("transform", "translate(" + margin.left + "," + margin.top + ")")
+        .attr("height", height + margin.top + margin.bottom)
+      .append("g")
+        .attr("class", "plot")
+        .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
 
-    d3.selectAll(".x")
+    svg.append("g")
+        .attr("class", "x axis")
         .attr("transform", "translate(0," + height + ")")
-        .call(xAxis.ticks(d3.time.months, 12));
-
-    d3.select(".last")
+        .call(xAxis.ticks(d3.time.months.utc, 12))
+      .append("text")
+        .attr("class", "last")
         .attr("x", width)
-        .text(formatDate(dateFn(last)) + ": " + formatCurrency(closeFn(last)));
+        .attr("y", -10)
+        .style("text-anchor", "end")
+        .text(label(last));
 
-    d3.selectAll(".y")
+    svg.append("g")
         .attr("class", "y axis")
         .call(yAxis);
 
-    d3.selectAll(".line")
-        .datum(data)        
+    svg.append("path")
+        .datum(indexes)
+        .attr("class", "line")
         .attr("d", line);
 
-    hoverLineVert.attr("y1", 0).attr("y2", height)
-    hoverLineHoriz.attr("x1", 0).attr("x2", width)
+    var hoverLineGroup = svg.append("g")
+        .attr("class", "hover-line");
+
+    var focus = svg.append("g")
+        .attr("class", "focus")
+        .style("display", "none");
+
+    focus.append("circle")
+        .attr("r", 4.5);
+
+    var hoverLineVert = hoverLineGroup
+        .append("line")
+          .attr("x1", margin.left)
+          .attr("x2", margin.left)
+          .attr("y1", 0)
+          .attr("y2", height)
+          .style("opacity", 1e-6);
+
+    var hoverLineHoriz = hoverLineGroup
+        .append("line")
+          .attr("x1", 0)
+          .attr("x2", width)
+          .attr("y1", 0)
+          .attr("y2", 0)
+          .style("opacity", 1e-6);
+
+    chart.on("mouseover", function() {
+    }).on("mousemove", adjustHover);
+
+    function adjustHover() {
+        var x0, i;
+        var mouse_x = d3.mouse(this)[0];
+
+        if (mouse_x < margin.left) {
+            i = 0; // focus and crosshairs stick at left side
+        } else if (mouse_x > margin.left + width) {
+            i = last; // focus and crosshairs stick at right side
+        } else {
+            x0 = x.invert(mouse_x - margin.left);
+            i = bisectDate(dates, x0, 1, last);
+            i = x0 - dates[i - 1] > dates[i] - x0 ? i : i - 1;
+        }
+
+        hoverLineVert
+            .attr("x1", x(dates[i]))
+            .attr("x2", x(dates[i]))
+            .style("opacity", 0.3);
+        hoverLineHoriz
+            .attr("y1", y(closes[i]))
+            .attr("y2", y(closes[i]))
+            .style("opacity", 0.3);
+        focus
+            .style("display", null)
+            .attr("transform", "translate(" + x(dates[i]) + "," + y(closes[i]) + ")")
+        d3.select(".last")
+            .text(label(i));
+    };
+
+    d3.select(window).on("resize", resize);
+
+    function resize() {
+        // update width
+        targetWidth = parseInt(chart.style("width"), 10);
+        width = targetWidth - margin.left - margin.right;
+        height = aspect * targetWidth - margin.top - margin.bottom;
+
+        // update x and y scales
+        x.range([0, width]);
+        y.range([height, 0]);
 
+        // update stuff that uses width, height, x or y
+        d3.selectAll("svg")
+            .attr("width", width + margin.left + margin.right)
+            .attr("height", height + margin.top + margin.bottom);
+        d3.selectAll(".plot")
+            .attr("transform", "translate(" + margin.left + "," + margin.top + ")")
+
+        d3.selectAll(".x")
+            .attr("transform", "translate(0," + height + ")")
+            .call(xAxis.ticks(d3.time.months.utc, 12));
+
+        d3.select(".last")
+            .attr("x", width)
+            .text(label(last));
+
+        d3.selectAll(".y")
+            .attr("class", "y axis")
+            .call(yAxis);
+
+        d3.selectAll(".line")
+            .datum(indexes)
+            .attr("d", line);
+
+        hoverLineVert.attr("y1", 0).attr("y2", height)
+        hoverLineHoriz.attr("x1", 0).attr("x2", width)
+
+    }
 }
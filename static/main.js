@@ -5,4 +5,70 @@ function toggleQuery() {
     } else {
         prompt.placeholder = "Manager...";
     }
-}
\ No newline at end of file
+}
+
+function loadHoldings(button) {
+    // Appends the next page of holdings rows from the /holdings endpoint
+    var offset = +button.getAttribute("data-offset"),
+        count = +button.getAttribute("data-count"),
+        limit = 100,
+        request = new XMLHttpRequest();
+
+    request.open("GET", "/holdings?filing_slug=" +
+        encodeURIComponent(button.getAttribute("data-slug")) +
+        "&offset=" + offset + "&limit=" + limit);
+    request.onload = function() {
+        var page = JSON.parse(request.responseText),
+            tbody = document.querySelector(".manager tbody");
+
+        page.rows.forEach(function(row) {
+            tbody.appendChild(holdingRow(row));
+        });
+
+        offset += page.rows.length;
+        button.setAttribute("data-offset", offset);
+        if (offset >= count || !page.rows.length) {
+            button.parentNode.parentNode.setAttribute("hidden", "hidden");
+        } else {
+            button.querySelector(".from").textContent = offset + 1;
+        }
+    };
+    request.send();
+}
+
+function holdingRow(row) {
+    // row is [issuer, cusip, ticker, value, weight, option]; value and
+    // weight are numbers, formatted here like the template's filters
+    var tr = document.createElement("tr"),
+        cells = [
+            ["issuer text-left", row[0], "http://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&count=100&CIK=&type=10-&ticker=" + encodeURIComponent(row[2])],
+            ["ticker text-center", row[2], "/" + encodeURIComponent(row[2])],
+            ["value text-right", row[3].toLocaleString("en-US")],
+            ["weight percent", row[4].toFixed(1) + "%"],
+            ["option text-center", row[5]]
+        ];
+
+    cells.forEach(function(cell) {
+        var td = document.createElement("td"),
+            content = td;
+        td.className = cell[0];
+        if (cell[0].indexOf("issuer") === 0) {
+            // mirror the outer/inner wrappers used by the template
+            content = td.appendChild(document.createElement("div"));
+            content.className = "outer";
+            content = content.appendChild(document.createElement("div"));
+            content.className = "inner";
+        }
+        if (cell[2]) {
+            content = content.appendChild(document.createElement("a"));
+            content.href = cell[2];
+            if (cell[0].indexOf("issuer") === 0) {
+                content.target = "_blank";
+            }
+        }
+        content.textContent = cell[1] || "";
+        tr.appendChild(td);
+    });
+
+    return tr;
+}
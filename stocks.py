@@ -1,38 +1,335 @@
+from array import array
+import bisect
 import datetime
+import errno
+import logging
+import os
 import re
+import struct
+import tempfile
 import urllib
 from google.appengine.api import urlfetch
 
-def get_prices(ticker):
-    """ Gets daily price information from Yahoo! Finance """
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+import fetch
+
+# CONSTANTS
+PRICES_DIR = os.environ.get('OPENSEC_PRICES_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prices'))
+PRICE = struct.Struct('<id') # day number (days since EPOCH), adj. close
+EPOCH = datetime.date(1970, 1, 1)
+
+def get_prices(ticker, start=None):
+    """ Gets daily price information from Yahoo! Finance, newest first,
+    from start (a datetime.date) if given, else the full history """
 
     ENDPOINT = 'http://ichart.finance.yahoo.com/table.csv?'
     params = dict(g='d', s=ticker)
+    if start is not None:
+        params.update(a=start.month - 1, b=start.day, c=start.year)
     params = urllib.urlencode(params)
-    data = urlfetch.fetch(ENDPOINT + params).content
+    data = fetch.get(ENDPOINT + params)
     lines = data.strip().split('\n')[1:]
     lines = [line.split(',') for line in lines]
 
     return lines
 
-def json_prices(ticker):
-    """ Gets daily adjusted close as json object """
+def day_number(date):
+    """ datetime.date or 'YYYY-MM-DD' => days since EPOCH """
+
+    if not isinstance(date, datetime.date):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+    return (date - EPOCH).days
+
+def day_date(day):
+    """ Days since EPOCH => datetime.date """
+
+    return EPOCH + datetime.timedelta(days=day)
+
+class Days:
+    """ Sequence view of the day numbers of packed PRICE records, for bisect """
+
+    def __init__(self, data, count):
+
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+
+        return self.count
+
+    def __getitem__(self, ix):
+
+        return PRICE.unpack_from(self.data, ix * PRICE.size)[0]
+
+class Series:
+    """ Daily adjusted closes of a ticker as PRICE records in ascending day
+    order, memory-mapped from the ticker's file if possible (else held as
+    a string). """
+
+    def __init__(self, data):
+
+        self.data = data
+        self.days = Days(data, len(data) // PRICE.size)
+
+    @classmethod
+    def from_file(cls, path):
+
+        with open(path, 'rb') as f:
+            if mmap and os.fstat(f.fileno()).st_size:
+                return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return cls(f.read())
+
+    def __len__(self):
+
+        return len(self.days)
+
+    def __getitem__(self, ix):
+        """ Returns (day, close) of record ix """
+
+        if ix < 0:
+            ix += len(self)
+        if not 0 <= ix < len(self):
+            raise IndexError(ix)
+
+        return PRICE.unpack_from(self.data, ix * PRICE.size)
+
+    def range(self, start=None, end=None):
+        """ Returns list of (day, close) with start <= day <= end (day
+        numbers; None is unbounded), oldest first """
+
+        lo = 0 if start is None else bisect.bisect_left(self.days, start)
+        hi = len(self) if end is None else bisect.bisect_right(self.days, end)
+
+        return [self[ix] for ix in xrange(lo, hi)]
+
+    def close_on(self, day):
+        """ Returns (day, close) of the last trading day on or before day,
+        or None if day precedes the series """
+
+        days, count = self.days, len(self.days)
+        if not count:
+            return None
+        first, last = days[0], days[count - 1]
+        if day < first:
+            return None
+        if day >= last:
+            return self[count - 1]
+
+        # Trading days are close to evenly spaced, so interpolate a first
+        # guess and step from it; bisect if it's far off (e.g. long halts)
+        ix = (day - first) * (count - 1) // (last - first)
+        for step in xrange(8):
+            if days[ix] > day:
+                ix -= 1
+            elif days[ix + 1] <= day:
+                ix += 1
+            else:
+                return self[ix]
+        ix = bisect.bisect_right(days, day)
+
+        return self[ix - 1]
+
+def _path(ticker):
+    return os.path.join(PRICES_DIR, re.sub(r'[^A-Z0-9.-]', '_', ticker.upper()))
+
+def load(ticker):
+    """ Returns stored Series for ticker, or None if there isn't one """
+
+    try:
+        return Series.from_file(_path(ticker))
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            logging.warning("prices for %s not loaded: %s", ticker, e)
+        return None
+
+def _fetch_rows(ticker, start=None):
+    """ Fetches (day number, adj. close) rows from start (see get_prices),
+    oldest first """
 
-    data = []
-    lines = get_prices(ticker)
-    for line in lines:
-        data.append(dict(Date=line[0], AdjClose=line[-1]))
+    return sorted((day_number(line[0]), float(line[-1]))
+        for line in get_prices(ticker, start))
 
-    return data
+def _rewrite(ticker, rows):
+    """ Replaces ticker's stored prices with rows, through a temporary file
+    and rename so readers never see a partial file. Returns the new Series,
+    in memory if the store can't be written (e.g. read-only filesystem). """
+
+    data = ''.join(PRICE.pack(*row) for row in rows)
+    try:
+        if not os.path.isdir(PRICES_DIR):
+            os.makedirs(PRICES_DIR)
+        fd, tmp = tempfile.mkstemp(dir=PRICES_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, _path(ticker))
+    except (IOError, OSError) as e:
+        logging.warning("prices for %s not stored: %s", ticker, e)
+        return Series(data)
+
+    return load(ticker)
+
+def _append(ticker, stored, rows):
+    """ Appends the rows after the file's last stored day to ticker's file.
+    The file is locked (where fcntl is available) while its last record is
+    read back, so concurrent updates append each day once. Returns the new
+    Series, in memory if the store can't be written. """
+
+    try:
+        with open(_path(ticker), 'a+b') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX) # released on close
+            size = os.fstat(f.fileno()).st_size
+            if size % PRICE.size: # partial record from an interrupted write
+                size -= size % PRICE.size
+                f.truncate(size)
+            last_day = None
+            if size:
+                f.seek(size - PRICE.size)
+                last_day = PRICE.unpack(f.read(PRICE.size))[0]
+            new = [row for row in rows if last_day is None or row[0] > last_day]
+            if new:
+                f.seek(0, os.SEEK_END)
+                f.write(''.join(PRICE.pack(*row) for row in new))
+    except (IOError, OSError) as e:
+        logging.warning("prices for %s not stored: %s", ticker, e)
+        return Series(stored.data[:] + ''.join(PRICE.pack(*row)
+            for row in rows if row[0] > stored[-1][0]))
+
+    return load(ticker)
+
+def update(ticker):
+    """ Brings ticker's stored Series up to date and returns it.
+    Only days after the last stored one are fetched, and appended to the
+    file. The last stored day is fetched again too: if its adjusted close
+    changed (a split or dividend since), the whole history is fetched and
+    the file rewritten, unless that fetch comes back empty. If prices
+    can't be fetched or parsed (e.g. an unknown ticker), returns the
+    stored Series, or an empty one; a stored Series is never replaced by
+    an empty one. """
+
+    stored = load(ticker)
+    last = stored[-1] if stored else None
+    if last and day_date(last[0]) >= get_weekday(datetime.date.today() -
+            datetime.timedelta(days=1)):
+        return stored
+
+    try:
+        rows = _fetch_rows(ticker, last and day_date(last[0]))
+        if last and rows and rows[0] != last: # adjusted closes changed
+            rows = _fetch_rows(ticker)
+            if rows:
+                return _rewrite(ticker, rows)
+        elif last and rows:
+            return _append(ticker, stored, rows[1:])
+        elif rows:
+            return _rewrite(ticker, rows)
+    except (IOError, ValueError, IndexError, urlfetch.Error) as e:
+        logging.warning("prices for %s not updated: %s", ticker, e)
+
+    return stored if stored is not None else Series('')
+
+def json_prices(ticker, limit=None):
+    """ Gets daily adjusted close as json object, newest first, for at most
+    limit trading days """
+
+    series = update(ticker)
+    count = min(limit or len(series), len(series))
+
+    return [dict(Date=day_date(day).isoformat(), AdjClose=close)
+        for day, close in (series[-ix] for ix in xrange(1, count + 1))]
+
+def lttb(points, threshold):
+    """ Downsamples (x, y) points, sorted by x, to threshold points with
+    Largest-Triangle-Three-Buckets: the first and last points are kept and
+    each bucket in between contributes the point forming the largest
+    triangle with the previous pick and the next bucket's average, so
+    peaks and troughs survive. Returns points as a list if there are no
+    more than threshold. """
+
+    count = len(points)
+    if threshold >= count or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    every = float(count - 2) / (threshold - 2)
+    a = 0
+    for i in xrange(threshold - 2):
+        lo, hi = int(i * every) + 1, int((i + 1) * every) + 1
+        after = points[hi:min(int((i + 2) * every) + 1, count)]
+        avg_x = sum(p[0] for p in after) / float(len(after))
+        avg_y = sum(p[1] for p in after) / float(len(after))
+
+        ax, ay = points[a]
+        best, best_area = lo, -1.
+        for j in xrange(lo, hi):
+            area = abs((ax - avg_x) * (points[j][1] - ay) -
+                (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+
+    return sampled
+
+def chart_prices(ticker, points=600, years=5):
+    """ Gets adjusted closes for the last 'years' years (all if 0),
+    downsampled to at most 'points' with lttb, as columns: dict of days
+    (days since EPOCH, ascending) and closes """
+
+    series = update(ticker)
+    if not len(series):
+        return dict(days=[], closes=[])
+
+    start = series[-1][0] - int(365.25 * years) if years else None
+    rows = lttb(series.range(start), points)
+
+    return dict(days=[day for day, close in rows],
+        closes=[close for day, close in rows])
 
 def get_weekday(date):
-    """ Returns nearest weekday in direction and magnitude of offset.
+    """ Returns date, or the Friday before it if it's a weekend day.
     Expects a datetime.date() object."""
 
-    while date.weekday() > 4:
-        date -= datetime.timedelta(days=1)
+    return date - datetime.timedelta(days=max(date.weekday() - 4, 0))
 
-    return date
+def returns(tickers, start_date, end_date, stale=7):
+    """ Returns dict of ticker => % change in adj. close from start_date to
+    end_date, from the local store only (see update).
+    Dates without a close (weekends, holidays) use the last close before
+    them; tickers not stored, not yet trading at start_date or without a
+    close in the 'stale' days up to either date map to None. """
+
+    start, end = day_number(start_date), day_number(end_date)
+    tickers = sorted(set(ticker for ticker in tickers if ticker))
+
+    # closes at both dates aligned by ticker, then one pass over the arrays
+    starts, ends = array('d'), array('d')
+    for ticker in tickers:
+        series = load(ticker)
+        first = series and series.close_on(start)
+        last = series and series.close_on(end)
+        if (first and last and first[0] > start - stale
+                and last[0] > end - stale and first[1]):
+            starts.append(first[1])
+            ends.append(last[1])
+        else:
+            starts.append(0.)
+            ends.append(0.)
+
+    return dict((ticker, b / a - 1 if a else None)
+        for ticker, a, b in zip(tickers, starts, ends))
 
 def get_prior_month_end(date):
     """Returns last calendar day of previous month
@@ -74,11 +371,11 @@ def end_of_month(date_str, months):
 
     return date
 
-#Need to re-write without Pandas
 def get_change(ticker, start_date_str, end_date_str):
     """ Returns % change for ticker, based on Yahoo adj. close, between dates
     Expects dates as integers or strings in format YYYYMMDD
-    or strings in format YYYY-MM-DD """
+    or strings in format YYYY-MM-DD. Dates without a close (weekends,
+    holidays) use the last close before them. """
 
     format = '%Y%m%d'
     start_date = str(start_date_str).replace("-", "")
@@ -89,25 +386,21 @@ def get_change(ticker, start_date_str, end_date_str):
         return None
     if end_date == datetime.datetime.today().date():
         end_date += datetime.timedelta(days=-1)
-    start_date = get_weekday(start_date)
-    end_date = get_weekday(end_date)
-    
+
     try:
-        stock = DataReader(ticker, "yahoo", start_date, end_date)
-    except IOError:
+        series = update(ticker)
+    except (IOError, ValueError, IndexError):
         return "NA:Sec"
-    
-    try:
-        start_price = stock["Adj Close"][start_date]
-    except KeyError:
+
+    start = series.close_on(day_number(start_date))
+    if start is None:
         return "NA:Beg"
-    
-    try:
-        end_price = stock["Adj Close"][end_date]
-    except KeyError:
+
+    end = series.close_on(day_number(end_date))
+    if end is None or end[0] < day_number(end_date) - 7:
         return "NA:End"
-    
-    return 1. * end_price / start_price - 1
+
+    return 1. * end[1] / start[1] - 1
 
 def cusip_to_ticker(cusip):
 
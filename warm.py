@@ -0,0 +1,128 @@
+""" Cache warmer for the most requested tickers and managers.
+
+Handlers count requests with Popularity.hit; counts are kept per instance
+and merged every so often into one shared dict in a memcache-compatible
+backend, so the ranking is approximate (concurrent merges can drop a few
+hits). A scheduled job (see cron.yaml and main.Warm) calls run, which
+passes the top keys of each kind to that kind's warmer, a few at a time
+and within a time budget, then decays the counts so the ranking follows
+recent traffic.
+"""
+
+import heapq
+import logging
+import os
+import threading
+import time
+
+from collections import Counter
+
+import fetch
+
+# CONSTANTS
+TOP = int(os.environ.get('OPENSEC_WARM_TOP', 300)) # keys warmed per run
+WORKERS = int(os.environ.get('OPENSEC_WARM_WORKERS', 4)) # keys at a time
+# seconds a run starts keys for, within the 10 minute cron request deadline
+BUDGET = float(os.environ.get('OPENSEC_WARM_BUDGET', 8 * 60))
+DECAY = 0.5 # counts are multiplied by this after each run
+KEEP = 5000 # most requested keys kept in the shared counts
+
+class Popularity:
+    """ Request counts per (kind, key), e.g. ('ticker', 'AAPL') or
+    ('manager', '0001067983'). Hits are merged into the backend under
+    'key' once flush_every have been counted or flush_secs have passed. """
+
+    def __init__(self, backend, key='warm|counts', flush_every=100,
+            flush_secs=60):
+
+        self.backend = backend
+        self.key = key
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.flushed = time.time()
+
+    def hit(self, kind, key):
+
+        with self.lock:
+            self.pending[(kind, key)] += 1
+            due = (sum(self.pending.values()) >= self.flush_every
+                or time.time() - self.flushed >= self.flush_secs)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Merges this instance's pending hits into the shared counts """
+
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            self.flushed = time.time()
+        if not pending:
+            return
+
+        counts = self.counts()
+        for item, hits in pending.items():
+            counts[item] = counts.get(item, 0) + hits
+        self._save(counts)
+
+    def counts(self):
+
+        return dict(self.backend.get(self.key) or {})
+
+    def top(self, n):
+        """ Returns the n most requested (kind, key) pairs, most first """
+
+        self.flush()
+        counts = self.counts()
+
+        return heapq.nlargest(n, counts, key=counts.get)
+
+    def decay(self, factor=DECAY):
+        """ Scales the shared counts by factor, dropping those under one """
+
+        counts = self.counts()
+        self._save(dict((item, hits * factor)
+            for item, hits in counts.items() if hits * factor >= 1))
+
+    def _save(self, counts):
+
+        if len(counts) > KEEP:
+            counts = dict((item, counts[item])
+                for item in heapq.nlargest(KEEP, counts, key=counts.get))
+        try:
+            self.backend.set(self.key, counts)
+        except ValueError as e: # e.g. too large for memcache
+            logging.warning("request counts not saved: %s", e)
+
+def run(popularity, warmers, top=TOP, workers=WORKERS, budget=BUDGET,
+        decay=DECAY):
+    """ Warms the 'top' most requested keys on 'workers' threads, most
+    requested first, then decays the counts. No key is started once
+    'budget' seconds have passed; those left are returned.
+    INPUT: warmers, dict of kind => function(key) returning True if it
+    rebuilt the key's cache entries (False if they were current)
+    OUTPUT: dict of keys, warmed, current, failed, seconds and remaining
+    (list of [kind, key] not started) """
+
+    started = time.time()
+    items = [item for item in popularity.top(top) if item[0] in warmers]
+
+    def warm((kind, key)):
+        if time.time() - started >= budget:
+            return 'remaining'
+        try:
+            return 'warmed' if warmers[kind](key) else 'current'
+        except Exception as e:
+            logging.warning("warming %s %s failed: %r", kind, key, e)
+            return 'failed'
+
+    results = fetch.pmap(warm, items, workers)
+    popularity.decay(decay)
+    counts = Counter(results)
+
+    return dict(keys=len(items), warmed=counts['warmed'],
+        current=counts['current'], failed=counts['failed'],
+        seconds=round(time.time() - started, 1),
+        remaining=[list(item) for item, result in zip(items, results)
+            if result == 'remaining'])